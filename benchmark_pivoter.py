@@ -0,0 +1,339 @@
+#! /bin/env python3
+
+# =============================================
+# GENERAL INFO
+# =============================================
+# Benchmark harness for survey_pivoter.py. Generates synthetic surveys (the
+# value, question to text and value to label workbooks, and a config file) at
+# configurable scale, runs the full pivot over a scaling matrix, and appends
+# the wall time and peak memory of every stage to a results file (one json
+# record per line), so that speedups and regressions can be tracked over
+# time without using confidential survey data. The records of the pivot 
+# runs also hold the stages of the pivot itself, from its --profile report.
+#
+# Example:
+#   python3 benchmark_pivoter.py --respondents 1000 10000 --questions 50 400 \
+#       --engine loop melt --results bench_results.jsonl
+
+# =============================================
+# LIBRARY IMPORTS
+# =============================================
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+import time
+import json
+import resource
+import platform
+import itertools
+import multiprocessing
+
+# =============================================
+# GLOBAL LITERALS
+# =============================================
+DEFAULT_WORKDIR = 'bench_data'
+DEFAULT_RESULTS = 'bench_results.jsonl'
+PROFILE_FILE = 'bench_profile.json'
+OUTPUT_FILE = '2017_synthetic_survey_pivoted.{}'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# =============================================
+# SYNTHETIC SURVEY
+# =============================================
+
+# generate a synthetic survey in directory, and return the path of its config
+# file. The survey has n_respondents rows, n_attributes attribute columns
+# (plus an id and a weight column) and n_questions question columns with a
+# domain of domain_size values. Questions are grouped by group_size (Q1_1,
+# Q1_2, ... sharing the start of their text), and a missing_rate share of
+# the responses are missing: half of them are left blank, and the other half
+# are "#NULL!", as in SPSS exports. The responses are integer codes, and the
+# "#NULL!" cells keep the question columns from being read as float (e.g. 
+# "4.0", which has no label), so that the labels are resolved and validated
+# as in real surveys. The generation is seeded, so the same parameters 
+# always produce the same survey.
+def generate_survey(directory, n_respondents, n_questions, domain_size=5, group_size=4, n_attributes=5,
+                    missing_rate=0.05, seed=0):
+    rng = np.random.RandomState(seed)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    values = {}
+    labels = []
+    domains = []
+
+    values['ResponseID'] = ['R_{:08d}'.format(i) for i in range(n_respondents)]
+    labels.append(('ResponseID', 'Response ID'))
+
+    for i in range(n_attributes):
+        name = 'V{}'.format(i + 1)
+        values[name] = rng.choice(['Category {}'.format(j) for j in range(1, 6)], n_respondents)
+        labels.append((name, 'Attribute {}'.format(i + 1)))
+
+    values['wt'] = rng.uniform(0.5, 1.5, n_respondents).round(4)
+    labels.append(('wt', 'Weight'))
+
+    domain_labels = ['Response option {}'.format(j) for j in range(1, domain_size + 1)]
+
+    for i in range(n_questions):
+        group = i // group_size + 1
+        if group_size > 1:
+            name = 'Q{}_{}'.format(group, i % group_size + 1)
+            text = 'How would you rate the following (group {}) - item {}'.format(group, i % group_size + 1)
+        else:
+            name = 'Q{}'.format(group)
+            text = 'How would you rate question {}'.format(group)
+
+        column = rng.randint(1, domain_size + 1, n_respondents).astype(object)
+        missing = rng.rand(n_respondents)
+        column[missing < missing_rate / 2] = None
+        column[(missing >= missing_rate / 2) & (missing < missing_rate)] = '#NULL!'
+        values[name] = column
+        labels.append((name, text))
+
+        for j, label in enumerate(domain_labels):
+            domains.append((name if j == 0 else None, j + 1, label))
+
+    write_xlsx(pd.DataFrame(values), os.path.join(directory, 'value.xlsx'))
+    write_xlsx(pd.DataFrame(labels, columns=['Name', 'Label']), os.path.join(directory, 'q_to_t_map.xlsx'))
+    write_xlsx(pd.DataFrame(domains, columns=['Question', 'Value', 'Label']),
+        os.path.join(directory, 'v_to_l_map.xlsx'))
+
+    config_file = os.path.join(directory, 'config.yml')
+    with open(config_file, 'w') as f:
+        f.write("\n".join([
+            "year: 2017",
+            "survey_name: 'Synthetic Survey'",
+            "weight_col: 'Weight'",
+            "input_filename_with_values: 'value.xlsx'",
+            "input_filename_questions_to_text: 'q_to_t_map.xlsx'",
+            "input_filename_values_to_labels: 'v_to_l_map.xlsx'",
+            "both_attribute_and_question: ['V1']",
+            "columns_to_ignore: []",
+            "common_string_threshold: 4",
+            "exclude_from_domain_analysis: ['Not applicable']",
+            ""]))
+
+    return config_file
+
+# write a data frame to an xlsx file, without index
+def write_xlsx(df, filename):
+    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    df.to_excel(writer, index=False, sheet_name="Sheet1")
+    writer.close()
+
+# =============================================
+# STAGES
+# =============================================
+# Every stage runs in a fresh process, so that its peak memory is measured
+# on its own.
+
+# peak resident memory of the current process, in MB
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+# run the generate stage for a case
+def run_generate(directory, case):
+    generate_survey(directory, case['respondents'], case['questions'], case['domain_size'],
+        case['group_size'], case['attributes'], case['missing_rate'], case['seed'])
+
+# run the pivot stage: the full survey_pivoter main() on config_file, from
+# the config file's directory, where the output is written
+def run_pivot(directory, args):
+    sys.path.insert(0, SCRIPT_DIR)
+    import survey_pivoter
+
+    os.chdir(directory)
+    sys.argv = ['survey_pivoter.py', 'config.yml'] + args
+    survey_pivoter.main()
+
+# child process target: run a stage, and send back its wall time and peak
+# memory, or its error
+def run_stage(queue, stage, *stage_args):
+    start_time = time.time()
+    try:
+        stage(*stage_args)
+        error = None
+    except BaseException as e:
+        error = repr(e)
+    queue.put({'wall_time': time.time() - start_time, 'peak_rss_mb': get_peak_rss_mb(), 'error': error})
+
+# run a stage in a fresh process, and return its measurements
+def measure_stage(stage, *stage_args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_stage, args=(queue, stage) + stage_args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+# =============================================
+# OUTPUT CHECK
+# =============================================
+# With --check, the output of every pivot run of a case is compared row for
+# row with the output of its first run (the first engine), in order, so 
+# that the engines can't drift apart unnoticed, even in the order of their
+# rows. The chunked runs sort their rows by question within each chunk of 
+# respondents, so they are compared once both outputs are sorted.
+
+# read the output file of a pivot run as text
+def read_output(filename):
+    if filename.endswith('.csv'):
+        output = pd.read_csv(filename, dtype=str, keep_default_na=False)
+    elif filename.endswith('.parquet'):
+        output = pd.read_parquet(filename).astype(str)
+    elif filename.endswith('.feather'):
+        output = pd.read_feather(filename).astype(str)
+    else:
+        output = pd.read_excel(filename, dtype=str, keep_default_na=False)
+    return output
+
+# sort the rows of an output by all its columns, so that outputs written in
+# a different row order compare equal
+def sort_output(output):
+    return output.sort_values(list(output.columns), kind='mergesort').reset_index(drop=True)
+
+# compare an output with the reference output of its case, and return None
+# if they are the same, or a description of their differences
+def compare_outputs(output, reference):
+    if list(output.columns) != list(reference.columns) or output.shape != reference.shape:
+        return "shape {} and columns differ from the reference, shape {}".format(output.shape, reference.shape)
+    mismatches = (output.values != reference.values).any(axis=1).sum()
+    if mismatches:
+        return "{} of {} rows differ from the reference".format(mismatches, len(output))
+    return None
+
+# =============================================
+# MAIN PROCESS
+# =============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark survey_pivoter.py on synthetic surveys")
+    parser.add_argument("--respondents", type=int, nargs='+', default=[1000, 10000],
+        help="Numbers of respondents of the scaling matrix")
+    parser.add_argument("--questions", type=int, nargs='+', default=[50, 200],
+        help="Numbers of questions of the scaling matrix")
+    parser.add_argument("--domain-size", type=int, nargs='+', default=[5],
+        help="Sizes of the questions' domains of the scaling matrix")
+    parser.add_argument("--group-size", type=int, default=4, help="Number of questions per group")
+    parser.add_argument("--attributes", type=int, default=5, help="Number of attribute columns")
+    parser.add_argument("--missing-rate", type=float, default=0.05, help="Share of blank responses")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic surveys")
+    parser.add_argument("--engine", nargs='+', default=["loop", "melt"], help="Pivot engines to run")
+    parser.add_argument("--output-format", default="csv", help="Output format of the pivot runs")
+    parser.add_argument("--chunk-size", type=int, nargs='*', default=[],
+        help="Chunk sizes of additional chunked pivot runs (melt engine), e.g. to --check them against the other runs")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of pivot runs per case")
+    parser.add_argument("--pivot-args", default="",
+        help="Extra arguments passed to survey_pivoter.py, e.g. \"--star-schema\"")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="Directory of the synthetic surveys")
+    parser.add_argument("--results", default=DEFAULT_RESULTS,
+        help="Results file, one json record is appended per stage run")
+    parser.add_argument("--check", action='store_true',
+        help="Check that the output of every pivot run of a case is the same as the output of its first run")
+    args = parser.parse_args()
+
+    environment = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+
+    results = open(args.results, 'a')
+    failures = []
+
+    for respondents, questions, domain_size in itertools.product(args.respondents, args.questions,
+            args.domain_size):
+        case = {
+            'respondents': respondents,
+            'questions': questions,
+            'domain_size': domain_size,
+            'group_size': args.group_size,
+            'attributes': args.attributes,
+            'missing_rate': args.missing_rate,
+            'seed': args.seed
+        }
+        directory = os.path.abspath(os.path.join(args.workdir,
+            'r{respondents}_q{questions}_d{domain_size}_g{group_size}_a{attributes}_m{missing_rate}_s{seed}'
+            .format(**case)))
+
+        # generate the survey once per case
+        runs = []
+        reference = None
+        if not os.path.exists(os.path.join(directory, 'config.yml')):
+            runs.append(('generate', {}, measure_stage(run_generate, directory, case)))
+
+        # the pivot runs of the case: every engine, then every chunk size
+        pivot_runs = [['--engine', engine] for engine in args.engine] + \
+            [['--engine', 'melt', '--chunk-size', str(chunk_size)] for chunk_size in args.chunk_size]
+
+        for run_args in pivot_runs:
+            pivot_args = run_args + ['--output-format', args.output_format, '--no-cache'] + args.pivot_args.split()
+            for i in range(args.repeat):
+                measures = measure_stage(run_pivot, directory, pivot_args + ['--profile', PROFILE_FILE])
+
+                # the stages of the pivot itself, from its profile report
+                profile_file = os.path.join(directory, PROFILE_FILE)
+                if os.path.exists(profile_file):
+                    with open(profile_file, 'r') as f:
+                        measures['pivot_stages'] = json.load(f)['stages']
+                    os.remove(profile_file)
+
+                # compare the output with the output of the first run, sorted
+                # for a chunked run
+                if args.check and not measures['error']:
+                    output = read_output(os.path.join(directory, OUTPUT_FILE.format(args.output_format)))
+                    if reference is None:
+                        reference = output
+                        measures['check'] = None
+                    elif '--chunk-size' in run_args:
+                        measures['check'] = compare_outputs(sort_output(output), sort_output(reference))
+                    else:
+                        measures['check'] = compare_outputs(output, reference)
+                        if measures['check']:
+                            failures.append((case, pivot_args, "[CHECK FAILED] {}".format(measures['check'])))
+
+                runs.append(('pivot', {'engine': run_args[1], 'args': pivot_args, 'run': i}, measures))
+
+        for stage, settings, measures in runs:
+            # the records of the failed runs are marked, and their timings
+            # are not shown, as they don't measure a whole run
+            measures['failed'] = measures['error'] is not None
+            record = dict(environment, stage=stage, case=case, settings=settings, **measures)
+            results.write(json.dumps(record) + "\n")
+            results.flush()
+
+            description = "{:>8} {:>8} respondents x {:>5} questions {:<40}".format(stage, respondents, questions,
+                " ".join(settings.get('args', [])))
+            if measures['failed']:
+                failures.append((case, settings.get('args', [stage]), "[ERROR] {}".format(measures['error'])))
+                print("{} [ERROR] {}".format(description, measures['error']))
+            else:
+                print("{} {:>10.2f} s {:>10.1f} MB{}".format(description, measures['wall_time'],
+                    measures['peak_rss_mb'], " [CHECK FAILED] {}".format(measures['check'])
+                    if measures.get('check') else ""))
+
+    results.close()
+    print('Benchmark results were appended to {}'.format(args.results))
+
+    # fail loudly if any run failed or any output check failed
+    if failures:
+        for case, run_args, failure in failures:
+            print("{} respondents x {} questions {}: {}".format(case['respondents'], case['questions'],
+                " ".join(run_args), failure))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
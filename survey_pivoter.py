@@ -13,462 +13,1225 @@
 import pandas as pd
 import numpy as np
 import os
-import yaml
-from collections import defaultdict
-from tqdm import tqdm
+from collections import defaultdict, OrderedDict
 import sys
 import argparse
 import time
+import copy
+import io
+import contextlib
+import importlib
+import threading
+import signal
+import queue
+import hashlib
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 # ============================================= 
 # GLOBAL LITERALS
 # =============================================
 ERROR_TAG = "[ERROR] "
 WARNING_TAG = "[WARNING] "
+CACHE_VERSION = 4
+CACHE_ENTRY_FILE = re.compile(r'^((?:values|domain)_[0-9a-f]{32})\.')
+PROFILE_SLOWEST_QUESTIONS = 20
+OUTPUT_FORMATS = ["xlsx", "parquet", "feather", "csv"]
+
+# columns of the output that hold the same few values on many rows, which
+# are dictionary encoded in the columnar output formats, together with all
+# the attribute columns
+CATEGORICAL_COLUMNS = ['Survey Name', 'Year', 'Question - Group ID', 'Question - Group Text', 
+                       'Question - ID', 'Question - Text']
+CSV_CHUNK_SIZE = 100000
+
+# columns of the output after the survey, year and attribute columns
+PIVOTED_COLUMNS = ['Question - Group ID', 'Question - Group Text', 'Question - ID', 'Question - Text', 
+                   'Response - Value', 'Response - Text', 'Property - Count Negative', 
+                   'Property - Normalized By Median', 'Property - Weight']
+
+# text cells read as empty cells (NaN) by pd.read_excel, its default 
+# na_values, which the chunked reader of the values file also applies
+EXCEL_NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', 
+                             '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null'])
+
+# columns of the output holding numeric properties, all the other ones but
+# the year hold text
+PROPERTY_COLUMNS = ['Property - Count Negative', 'Property - Normalized By Median']
+
+# columns of the fact table of the star schema output
+FACT_COLUMNS = ['Respondent - ID', 'Question - ID', 'Response - Value', 'Response - Text', 
+                'Property - Count Negative', 'Property - Normalized By Median']
+
+# columns of the question dimension table
+QUESTION_DIMENSION_COLUMNS = ['Question - Group ID', 'Question - Group Text', 'Question - Text', 
+                              'Question - Domain', 'Property - Count Negative Map', 
+                              'Property - Normalized By Median Map']
+
+# control characters removed from the text of the inputs, and the table 
+# that replaces each of them with a comma in a single pass
+CONTROL_CHARACTERS = '[\r\t\n]'
+CLEAN_TEXT_TABLE = str.maketrans({'\r': ', ', '\t': ', ', '\n': ', '})
+
+# columns of the question metadata of the response cube output, and the
+# partial sums aggregated per question and response (and attributes)
+CUBE_QUESTION_COLUMNS = ['Survey Name', 'Year', 'Question - Group ID', 'Question - Group Text',
+                         'Question - Text']
+CUBE_SUM_COLUMNS = ['Response - Count', 'Response - Weighted Count', 'Normalized By Median - Weight',
+                    'Normalized By Median - Weighted Sum', 'Count Negative - Weight',
+                    'Count Negative - Weighted Sum']
+
+# columns of the validation report, one row per problem found in the inputs
+VALIDATION_COLUMNS = ['Severity', 'Check', 'Question', 'Value', 'Count', 'Message']
+
+# number of parsed mapping files (question to text and value to label 
+# files) kept in memory by every process, see read_mapping_file
+MAPPING_CACHE_SIZE = 32
+
+# maximum number of finished jobs whose status is kept by the pivot server
+SERVER_MAX_JOBS = 1000
+
+# maximum number of data rows in an excel sheet (1,048,576 rows minus the
+# header row)
+EXCEL_MAX_ROWS = 1048575
 
 # =============================================
-# PREPROCESSING FILE
-# ============================================= 
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("config_file", help="Path to config yaml file with survey-specific settings " + 
-        "(e.g. config.yml)")
-    args = parser.parse_args()
+# PROFILING
+# =============================================
+# In profiling mode, main() records every named stage of the process in a 
+# profile: its wall time, the peak memory of the process at the end of the
+# stage, and the number of rows and columns of the data frame it produced.
+# The profile is written as a json report.
+
+# peak resident memory of the process so far, in MB. Returns None where it 
+# can't be measured (the resource module is not available on Windows)
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+# create an empty profile, with the current time as the start of the first 
+# stage
+def create_profile(settings):
+    now = time.time()
+    return {'settings': settings, 'start_time': now, 'last_time': now, 'stages': [], 'questions': []}
+
+# record a stage in the profile (if any), which lasted since the end of the
+# previous stage. frame is the data frame produced by the stage, or a list 
+# of data frames with the same columns, if any.
+def profile_stage(profile, name, frame=None):
+    if profile is None:
+        return
+
+    now = time.time()
+    stage = {'name': name, 'wall_time': now - profile['last_time'], 'peak_rss_mb': get_peak_rss_mb()}
+    if isinstance(frame, list):
+        stage['rows'] = int(sum(len(item) for item in frame))
+        stage['columns'] = int(frame[0].shape[1]) if frame else 0
+    elif frame is not None:
+        stage['rows'] = int(frame.shape[0])
+        stage['columns'] = int(frame.shape[1])
+
+    profile['stages'].append(stage)
+    profile['last_time'] = now
+
+# write the profile as a json report, with only the slowest questions
+def write_profile(profile, filename):
+    slowest = sorted(profile['questions'], key=lambda question: -question['wall_time'])
+    report = {
+        'settings': profile['settings'],
+        'total_time': time.time() - profile['start_time'],
+        'peak_rss_mb': get_peak_rss_mb(),
+        'stages': profile['stages'],
+        'slowest_questions': slowest[:PROFILE_SLOWEST_QUESTIONS]
+    }
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
 
-    config_file = args.config_file
-    curr_map = {}
-    warning_messages = []
+# =============================================
+# TEXT CLEANING
+# =============================================
 
-    # parse the yaml file and store information into the appropriate
-    # variables
-    with open(config_file, 'r') as ymlfile:
-        try:
-            cfg = yaml.load(ymlfile)
-            year = cfg['year']
-            survey_name = cfg['survey_name']
-            weight_col = cfg['weight_col']
-            input_filename_v = cfg['input_filename_with_values']
-            input_filename_questions_to_text = cfg['input_filename_questions_to_text']
-            input_filename_values_to_labels = cfg['input_filename_values_to_labels']            
-            both_attribute_and_question = cfg['both_attribute_and_question']
-            columns_to_ignore = cfg['columns_to_ignore']
-            exclude_from_domain_analysis = cfg['exclude_from_domain_analysis']
-            common_string_threshold = cfg['common_string_threshold']
-        except KeyError as e:
-            raise KeyError("Expected variable {} in config file {} but it wasn't found".format(e, config_file))
+# dtype of the cleaned text columns: strings stored in arrow buffers when 
+# pyarrow is available, which take much less memory than python objects, or
+# the nullable string dtype of pandas otherwise. Both keep nulls as <NA>.
+def get_string_dtype():
+    try:
+        return pd.StringDtype("pyarrow")
+    except ImportError:
+        return pd.StringDtype()
+
+# clean a text column: convert its values to strings, keeping nulls as 
+# nulls, and replace the \r, \t and \n characters with a comma in a single
+# translation pass, only run if the column has any of them
+def clean_text_column(column):
+    column = column.astype(get_string_dtype())
+    if column.str.contains(CONTROL_CHARACTERS, regex=True).any():
+        column = column.str.translate(CLEAN_TEXT_TABLE)
+    return column
+
+# clean the dataframe for \n, \r and \t characters, converting its 
+# object columns (but the first one) to the compact string dtype, see 
+# clean_text_column. Empty cells stay null, instead of becoming "nan".
+def clean_dataframe(df):
+    for v in df.select_dtypes([object]).columns[1:]:
+        df[v] = clean_text_column(df[v])
+
+# build a categorical from the codes of a column into its categories (-1
+# for the empty cells), merging the categories that are equal
+def get_categorical(codes, categories):
+    inverse, uniques = pd.factorize(np.asarray(categories, dtype=object))
+    valid = codes >= 0
+    merged_codes = np.full(len(codes), -1)
+    merged_codes[valid] = inverse[codes[valid]]
+    return pd.Categorical.from_codes(merged_codes, pd.Index(uniques, dtype=object))
+
+# convert a column of the values file to the compact form of the value data
+# frame: a categorical, i.e. an array of small integer codes (-1 for the 
+# empty cells) into the distinct values of the column. The values are 
+# converted to text and cleaned (see clean_text_column) once per distinct
+# value, unless clean is False.
+def get_value_column(column, clean=True):
+    # the distinct values keep their own type (e.g. the integers of an object
+    # column are not turned into floats), with timestamps as Timestamp objects
+    values = column.values if column.dtype.kind in 'biuf' else column.astype(object).values
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    if clean:
+        uniques = clean_text_column(uniques)
+    return pd.Series(get_categorical(codes, uniques), index=column.index, name=column.name)
+
+# replace the "#NULL!" values (missing values exported by SPSS) of the 
+# string and categorical columns of a data frame with "No response", in 
+# place. Only the categories of the categorical columns are replaced.
+def replace_null_values(df):
+    for v in df.columns:
+        if isinstance(df[v].dtype, pd.CategoricalDtype):
+            categories = df[v].cat.categories
+            if "#NULL!" in categories:
+                df[v] = get_categorical(df[v].cat.codes.values, categories.where(categories != "#NULL!",
+                    "No response"))
+        elif df[v].dtype == object or isinstance(df[v].dtype, pd.StringDtype):
+            null_values = (df[v] == "#NULL!").fillna(False).astype(bool)
+            if null_values.any():
+                df[v] = df[v].mask(null_values, "No response")
 
-    exclude_from_domain_analysis = [item.lower() for item in exclude_from_domain_analysis]
-    output_file = '{}_{}_pivoted.xlsx'.format(year, survey_name.lower().replace(' ', '_'))
+# =============================================
+# INPUT CACHE
+# =============================================
+# The parsed and cleaned inputs are stored as parquet files in the cache 
+# directory, keyed by the content of the input files and the config values
+# they depend on, so that repeated runs over the same inputs don't have to 
+# read the xlsx files again. Every entry is made of its parquet files and a 
+# json file, which is written last and lists the entry's data frames.
+
+# compute the hash of the content of a file
+def hash_file(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# compute the key of a cache entry from the hashes of its input files and the
+# config values it depends on
+def get_cache_key(name, file_hashes, settings):
+    key = json.dumps([CACHE_VERSION, name, file_hashes, settings], sort_keys=True, default=str)
+    return "{}_{}".format(name, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+# get the key of the cache entry of a file name of the cache directory, or
+# None if the file is not part of a cache entry (see CACHE_ENTRY_FILE), so
+# that the other files of the directory are never touched
+def get_cache_entry_key(filename):
+    match = CACHE_ENTRY_FILE.match(filename)
+    return match.group(1) if match else None
+
+# get the files of the cache entry key
+def get_cache_files(cache_dir, key):
+    return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if get_cache_entry_key(f) == key]
+
+# read the data frames and the extra data of a cache entry. Returns None if 
+# the entry doesn't exist or can't be read.
+def read_cache(cache_dir, key):
+    meta_file = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(meta_file):
+        return None
 
-    # =============================================
-    # FUNCTIONS DEFINITION
-    # ============================================= 
+    try:
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        frames = {name: pd.read_parquet(os.path.join(cache_dir, '{}.{}.parquet'.format(key, name))) 
+            for name in meta['frames']}
+    except Exception as e:
+        print((WARNING_TAG + "Could not read cache entry {}, ignoring it. Error log: {}").format(key, e))
+        return None
 
-    # get the labels (text) for columns' variables. The label_list (returned 
-    # value) is structured as a list that contains the corresponding textual
-    # label for the columns' name of the original data frame, ordered in the
-    # same as the order of the columns.
-    def get_variable_labels(filename, varnames):
+    # mark the entry as recently used, for eviction
+    for filename in get_cache_files(cache_dir, key):
+        os.utime(filename, None)
 
-        # open the file here
-        try:
-            l_v_df = pd.read_excel(filename)
-        except Exception as e:
-            print("Reading error for \"{}\". Exiting.".format(filename))
-            print("Error log: {}".format(e))
-            quit()
-
-        # clean data frame for \t, \r and \n symbols
-        clean_dataframe(l_v_df)
-
-        # create a map from Name column to Label column
-        l_v_map = dict(zip(l_v_df["Name"], l_v_df["Label"]))
-        
-        label_list = []
+    return frames, meta['data']
 
-        # going through the relevant column names, and find the right textual
-        # label for it
-        for name in varnames:
-            if name in l_v_map:
-                label_list.append(l_v_map[name])
-            else:
-                print((WARNING_TAG + "Missing label for value \"{}\". Use original value instead").format(name))
-                label_list.append(name)
-        
-        return label_list
-
-    # obtain the domain for each question. The domain map is structured as a 
-    # map of maps, with the key being the question ID. The inner map has keys
-    # being the question's possible response numeric values, and the values 
-    # being the corresponding text.
-    def get_variable_value_domain(filename):
+# write the data frames and the extra data (json serializable) of a cache 
+# entry, then evict the least recently used entries to keep the cache 
+# under max_size_mb. A failure to write is not fatal, the entry is skipped.
+def write_cache(cache_dir, key, frames, data, max_size_mb):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for name, frame in frames.items():
+            frame.to_parquet(os.path.join(cache_dir, '{}.{}.parquet'.format(key, name)))
+        with open(os.path.join(cache_dir, key + '.json'), 'w') as f:
+            json.dump({'frames': list(frames), 'data': data}, f)
+    except Exception as e:
+        print((WARNING_TAG + "Could not write cache entry {}, skipping it. Error log: {}").format(key, e))
+        if os.path.isdir(cache_dir):
+            for filename in get_cache_files(cache_dir, key):
+                os.remove(filename)
+        return
+
+    evict_cache(cache_dir, max_size_mb, keep=key)
+
+# remove the least recently used entries of the cache until their total 
+# size is at most max_size_mb. The entry keep is never removed, and neither
+# are the files of the cache directory that are not part of an entry.
+def evict_cache(cache_dir, max_size_mb, keep=None):
+    entries = defaultdict(lambda: [0, 0.0, []])
+    for f in os.listdir(cache_dir):
+        key = get_cache_entry_key(f)
+        if key is None:
+            continue
+        filename = os.path.join(cache_dir, f)
+        entry = entries[key]
+        entry[0] += os.path.getsize(filename)
+        entry[1] = max(entry[1], os.path.getmtime(filename))
+        entry[2].append(filename)
+
+    total_size = sum(entry[0] for entry in entries.values())
+    for key, (size, last_used, filenames) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total_size <= max_size_mb * 1024 * 1024:
+            break
+        if key == keep:
+            continue
+        for filename in filenames:
+            os.remove(filename)
+        total_size -= size
 
-        try:
-            range_df = pd.read_excel(filename)
-        except Exception as e:
-            print("Reading error for \"{}\". Exiting.".format(filename))
-            print("Error log: {}".format(e))
-            quit()
+# =============================================
+# INCREMENTAL PIVOT
+# =============================================
+# In incremental mode, every run stores its final product (as a parquet
+# file) and a manifest of fingerprints in the state directory. The next run
+# only pivots the questions whose fingerprint changed, and splices them into
+# the previous final product. A question's fingerprint covers its values,
+# its label and its resolved metadata (group and question texts, domain and
+# property maps), so a question whose group text changed because of another
+# question of its group is pivoted again as well. Everything shared by all
+# questions (attributes, weights, respondents and config values) makes up
+# the settings fingerprint, and any change to it pivots every question again.
+
+# compute the hash of a data frame or series, index included
+def hash_frame(frame):
+    return hashlib.sha256(pd.util.hash_pandas_object(frame, index=True).values.tobytes()).hexdigest()
+
+# compute the hash of json serializable data
+def hash_data(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# state files of an output file: its previous final product and manifest
+def get_incremental_files(incremental_dir, output_file):
+    name = os.path.splitext(os.path.basename(output_file))[0]
+    return os.path.join(incremental_dir, name + '.parquet'), os.path.join(incremental_dir, name + '.json')
+
+# read the manifest and the previous final product of an output file.
+# Returns None if there is no state, or it can't be read.
+def read_incremental_state(incremental_dir, output_file):
+    output_state, manifest_file = get_incremental_files(incremental_dir, output_file)
+    if not os.path.exists(manifest_file):
+        return None
 
-        # rename the columns in the filename for easy use
-        range_df.rename(columns=dict(zip(range_df.columns, ["Question", "Value", "Label"])), inplace=True)
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        previous_product = pd.read_parquet(output_state)
+    except Exception as e:
+        print((WARNING_TAG + "Could not read the incremental state of {}, pivoting all questions. "
+            + "Error log: {}").format(output_file, e))
+        return None
 
-        # clean data frame for \t, \r and \n symbols
-        clean_dataframe(range_df)
+    if manifest.get('version') != CACHE_VERSION:
+        return None
 
-        domain_map = {}
+    return manifest, previous_product
 
-        curr_question = ""
+# write the final product and the manifest of an output file. The manifest
+# is written last, so a partial state is never read. A failure to write is
+# not fatal, the next run pivots all questions.
+def write_incremental_state(incremental_dir, output_file, final_product, manifest):
+    output_state, manifest_file = get_incremental_files(incremental_dir, output_file)
+    try:
+        if not os.path.isdir(incremental_dir):
+            os.makedirs(incremental_dir)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        final_product.to_parquet(output_state)
+        with open(manifest_file, 'w') as f:
+            json.dump(dict(manifest, version=CACHE_VERSION), f)
+    except Exception as e:
+        print((WARNING_TAG + "Could not write the incremental state of {}. Error log: {}").format(output_file, e))
 
-        # go through each row of the data frame, and update the domain of the 
-        # current question, or create a new domain for a new question. If the 
-        # question id is null, then the response value belongs to the current
-        # question, otherwise, a new question with new domain should be added
-        # to the map.
-        for row in range_df.itertuples():
-            index = row[0]
+# =============================================
+# OUTPUT
+# =============================================
 
-            question = row[1]
+# convert the repetitive columns of the output (see CATEGORICAL_COLUMNS) 
+# and the attribute columns to categoricals, so that they are dictionary
+# encoded by the columnar output formats
+def to_categorical(final_product):
+    final_product = final_product.copy()
+    for v in final_product.columns:
+        if v in CATEGORICAL_COLUMNS or v.startswith("Attribute - "):
+            final_product[v] = final_product[v].astype('category')
+    return final_product
+
+# write a data frame to the first sheet of an xlsx file
+def write_xlsx(final_product, output_file):
+    # save as excel (smaller file size, longer write time)
+    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
+        final_product.to_excel(writer, startcol=0, startrow=0, index=False, sheet_name="Sheet1")
+
+# get the group id and the number of rows of every question of the final
+# product, in order of first appearance. Without a group column (e.g. in a
+# fact table), every question is its own group.
+def get_questions_info(final_product):
+    group_col = 'Question - Group ID' if 'Question - Group ID' in final_product.columns else 'Question - ID'
+    return final_product.groupby('Question - ID', sort=False)[group_col].agg(['first', 'size'])
+
+# split the rows of the final product into shards of at most max_rows rows. 
+# Questions of the same group always go to the same shard, unless the group
+# doesn't fit in a single shard, in which case it is split between its 
+# questions. Returns the list of shards, each shard being the list of its
+# question ids, in order of first appearance.
+def get_xlsx_shards(final_product, max_rows):
+    questions_info = get_questions_info(final_product)
+    question_rows = questions_info['size']
+    question_groups = questions_info['first']
+
+    # the questions of each group, in order of first appearance
+    groups = defaultdict(list)
+    for question in question_rows.index:
+        groups[question_groups[question]].append(question)
+
+    shards = [[]]
+    shard_rows = 0
+    for group, questions in groups.items():
+        group_rows = question_rows[questions].sum()
+
+        # a group bigger than a shard has to be split between its questions
+        if group_rows > max_rows:
+            print((WARNING_TAG + "Question group {} has {} rows and doesn't fit in a single xlsx file, " + 
+                "so it will be split between files").format(group, group_rows))
+            blocks = [[question] for question in questions]
+        else:
+            blocks = [questions]
+
+        for block in blocks:
+            block_rows = question_rows[block].sum()
+            if block_rows > max_rows:
+                raise ValueError("Question {} has {} rows, which is more than the {} rows of an xlsx file".format(
+                    block[0], block_rows, max_rows))
+            if shard_rows + block_rows > max_rows:
+                shards.append([])
+                shard_rows = 0
+            shards[-1].extend(block)
+            shard_rows += block_rows
+
+    return shards
+
+# write the final product as several xlsx files of at most max_rows rows, 
+# written in parallel, keeping the questions of a group in the same file (see
+# get_xlsx_shards). A manifest listing the questions of each file is written
+# next to them. Returns the list of written files.
+def write_xlsx_shards(final_product, output_file, max_rows):
+    base, ext = os.path.splitext(output_file)
+    shards = get_xlsx_shards(final_product, max_rows)
+    shard_files = ['{}_part{}{}'.format(base, i + 1, ext) for i in range(len(shards))]
+
+    questions_info = get_questions_info(final_product)
+
+    manifest = []
+    with ProcessPoolExecutor(max_workers=min(len(shards), os.cpu_count() or 1)) as executor:
+        futures = []
+        for shard_file, questions in zip(shard_files, shards):
+            shard = final_product[final_product['Question - ID'].isin(questions)]
+            futures.append(executor.submit(write_xlsx, shard, shard_file))
+
+            for question in questions:
+                manifest.append((os.path.basename(shard_file), questions_info.loc[question, 'first'], 
+                    question, questions_info.loc[question, 'size']))
+
+        # raise the errors of the workers, if any
+        for future in futures:
+            future.result()
+
+    manifest_file = '{}_manifest.csv'.format(base)
+    pd.DataFrame(manifest, columns=['File', 'Question - Group ID', 'Question - ID', 'Rows']).to_csv(
+        manifest_file, index=False)
+
+    return shard_files + [manifest_file]
+
+# write the final product to output_file in the given output format. The xlsx
+# output is split between several files if it has more than max_rows rows.
+# Returns the list of written files.
+def write_output(final_product, output_file, output_format, max_rows=EXCEL_MAX_ROWS):
+    if output_format == "xlsx":
+        if len(final_product) > max_rows:
+            return write_xlsx_shards(final_product, output_file, max_rows)
+
+        write_xlsx(final_product, output_file)
+
+    elif output_format == "parquet":
+        to_categorical(final_product).to_parquet(output_file, index=False)
+
+    elif output_format == "feather":
+        # feather doesn't store the index, and requires a default one
+        to_categorical(final_product).reset_index(drop=True).to_feather(output_file)
+
+    elif output_format == "csv":
+        # save as csv (larger file size, faster write time), streamed to the
+        # file in chunks of rows
+        final_product.to_csv(output_file, index=False, chunksize=CSV_CHUNK_SIZE)
+
+    else:
+        raise ValueError("Unknown output format {}, expected one of {}".format(output_format, 
+            ", ".join(OUTPUT_FORMATS)))
+
+    return [output_file]
+
+# write the final product as a star schema instead of a single long table:
+# a slim fact table with one row per respondent and question, next to the 
+# question dimension table (see QUESTION_DIMENSION_COLUMNS) and the 
+# respondent dimension table (survey, year, attributes and weight of each 
+# respondent). The fact table refers to the dimension tables by question id
+# and respondent id. The domain and property maps of the question dimension
+# are written as json. Returns the list of written files.
+def write_star_schema(final_product, question_dimension, respondent_dimension, output_file, output_format,
+                      max_rows=EXCEL_MAX_ROWS):
+    base, ext = os.path.splitext(output_file)
+
+    facts = final_product[FACT_COLUMNS[1:]].copy()
+    facts.insert(0, 'Respondent - ID', final_product.index)
+
+    questions = question_dimension.copy()
+    for v in ['Question - Domain', 'Property - Count Negative Map', 'Property - Normalized By Median Map']:
+        questions[v] = questions[v].apply(lambda item: json.dumps(item, default=str))
+    questions.index.name = 'Question - ID'
+    questions = questions.reset_index()
+
+    output_files = write_output(facts, '{}_facts{}'.format(base, ext), output_format, max_rows)
+    output_files += write_output(questions, '{}_questions{}'.format(base, ext), output_format, max_rows)
+    output_files += write_output(respondent_dimension, '{}_respondents{}'.format(base, ext), output_format, 
+        max_rows)
+
+    return output_files
 
-            # store the question id (served as the key)
-            if pd.isnull(question):
-                question = curr_question
-            else:
-                curr_question = question
+# =============================================
+# RESPONSE CUBE
+# =============================================
+# The response cube is a small companion output of the final product, with
+# one row per question and response, optionally crossed with some attribute
+# columns: the number of responses, their weighted count and share, the 
+# weighted mean of the normalized by median property and the weighted share
+# of count negative. It is aggregated once, right after pivoting, so that 
+# reporting tools don't have to scan the whole final product. In chunked 
+# mode, the partial sums of every chunk are added up.
+
+# aggregate the responses of a final product (or of a chunk of it) into the
+# partial sums of the response cube (see CUBE_SUM_COLUMNS), per question,
+# attribute columns cube_cols (as named in the final product) and response.
+# The properties are looked up once per question and response in the 
+# property tables of the questions (see compile_property_tables), and are 
+# only summed over the responses that are in their question's property maps:
+# the responses excluded from the domain analysis or outside of the domain,
+# which keep their value in the property columns of the final product, are
+# left out. The question metadata is taken from the first response of each
+# question.
+def aggregate_responses(final_product, cube_cols, property_tables):
+    key_cols = ['Question - ID'] + cube_cols + ['Response - Value', 'Response - Text']
+
+    sums = final_product[key_cols].copy()
+    sums['Response - Count'] = 1
+    sums['Response - Weighted Count'] = pd.to_numeric(final_product['Property - Weight'].to_numpy(dtype=object),
+        errors='coerce')
+    sums = sums.groupby(key_cols, sort=False, dropna=False, observed=True)[
+        ['Response - Count', 'Response - Weighted Count']].sum().reset_index()
+
+    # the properties are the same for all the responses of a group
+    weighted_count = sums['Response - Weighted Count'].values
+    negative, normalized = map_values_to_properties(sums['Question - ID'].values, sums['Response - Value'].values,
+        property_tables, mapped_only=True)
+    sums['Normalized By Median - Weight'] = np.where(np.isnan(normalized), np.nan, weighted_count)
+    sums['Normalized By Median - Weighted Sum'] = weighted_count * normalized
+    sums['Count Negative - Weight'] = np.where(np.isnan(negative), np.nan, weighted_count)
+    sums['Count Negative - Weighted Sum'] = weighted_count * negative
+
+    # the attribute columns of the value data frame are categoricals
+    for v in cube_cols:
+        sums[v] = sums[v].astype(object)
+
+    questions = final_product.groupby('Question - ID', sort=False)[CUBE_QUESTION_COLUMNS].first()
+    return sums.join(questions, on='Question - ID')
+
+# build the response cube from the partial sums of one or more chunks of the
+# final product (see aggregate_responses). The weighted share of a response
+# is relative to all the responses of its question, for the same values of
+# the attribute columns cube_cols. The means are NaN for questions without
+# domain. The rows are sorted by question, attributes and response value.
+def get_response_cube(partial_sums, cube_cols):
+    key_cols = CUBE_QUESTION_COLUMNS + ['Question - ID'] + cube_cols + ['Response - Value', 'Response - Text']
+
+    sums = pd.concat(partial_sums)
+    if len(partial_sums) > 1:
+        sums = sums.groupby(key_cols, sort=False, dropna=False)[CUBE_SUM_COLUMNS].sum().reset_index()
+
+    cell_weight = sums.groupby(['Question - ID'] + cube_cols, sort=False, dropna=False)[
+        'Response - Weighted Count'].transform('sum')
+
+    cube = sums[['Survey Name', 'Year'] + cube_cols + ['Question - Group ID', 'Question - Group Text',
+        'Question - ID', 'Question - Text', 'Response - Value', 'Response - Text', 'Response - Count',
+        'Response - Weighted Count']].copy()
+    cube['Response - Weighted Share'] = sums['Response - Weighted Count'] / cell_weight
+    cube['Property - Weighted Mean Normalized By Median'] = (sums['Normalized By Median - Weighted Sum'] /
+        sums['Normalized By Median - Weight'])
+    cube['Property - Weighted Share Count Negative'] = (sums['Count Negative - Weighted Sum'] /
+        sums['Count Negative - Weight'])
+
+    return cube.sort_values(['Question - ID'] + cube_cols + ['Response - Value'], kind='mergesort').reset_index(
+        drop=True)
 
-            # store the response_value
-            response_value = row[2]
-            if pd.isnull(response_value): 
-                continue
-            response_value = int(response_value)
+# =============================================
+# CHUNKED PROCESSING
+# =============================================
 
-            # store the response_text
-            response_text = row[3]
-            if pd.isnull(response_text):
+# read the first sheet of an xlsx file in chunks of at most chunk_size rows,
+# without loading the whole file in memory. The first row is the header. Each
+# chunk is a data frame indexed by row number (starting at 0 after the 
+# header, as with pd.read_excel), and empty rows are skipped. The columns 
+# get the same values and dtypes as with pd.read_excel on the whole file: 
+# integral numbers are read as int, and empty cells and the text cells of 
+# EXCEL_NA_VALUES (e.g. "N/A") as NaN, in object columns, but the
+# numeric columns (of numbers and empty cells only) with any empty or 
+# non-integral cell are read as float. These columns are found by a first 
+# pass over the file, so that every chunk gets the dtypes of the whole file.
+def read_excel_chunks(filename, chunk_size):
+    # openpyxl is only needed for the chunked mode
+    import openpyxl
+
+    def is_empty(cell):
+        return cell is None or (isinstance(cell, str) and cell in EXCEL_NA_VALUES)
+
+    def convert(cell):
+        if is_empty(cell):
+            return np.nan
+        if isinstance(cell, float) and cell.is_integer():
+            return int(cell)
+        return cell
+
+    def is_number(cell):
+        return isinstance(cell, (int, float)) and not isinstance(cell, bool)
+
+    # the rows of the first sheet after the header, padded or trimmed to the
+    # length of the header, without the empty rows
+    def read_rows(sheet, header):
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            if all(cell is None for cell in row):
                 continue
-            
-            # there is no domain for the question
-            if not question in domain_map:                   
-                domain_map[question] = {}
+            yield (list(row) + [None] * (len(header) - len(row)))[:len(header)]
 
-            if response_value in domain_map[question]:
-                print("Duplicated labels for key {} in question {}. Please resolve the issue! Exiting...".format(response_value, question))
-                quit()
-            domain_map[question][response_value] = response_text
+    # build a chunk from its rows, converting the float columns
+    def get_chunk(chunk, header, float_columns, start):
+        chunk = pd.DataFrame(chunk, columns=header, dtype=object, index=range(start, start + len(chunk)))
+        return chunk.astype({header[i]: float for i in float_columns})
 
-        return domain_map
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        header = list(next(sheet.iter_rows(max_row=1, values_only=True)))
+
+        # first pass: find the numeric columns with an empty or non-integral
+        # cell
+        numeric = [True] * len(header)
+        inexact = [False] * len(header)
+        for row in read_rows(sheet, header):
+            for i, cell in enumerate(row):
+                if is_empty(cell):
+                    inexact[i] = True
+                elif not is_number(cell):
+                    numeric[i] = False
+                elif isinstance(cell, float) and not cell.is_integer():
+                    inexact[i] = True
+        float_columns = [i for i in range(len(header)) if numeric[i] and inexact[i]]
+
+        chunk = []
+        start = 0
+        for row in read_rows(sheet, header):
+            chunk.append([convert(cell) for cell in row])
+
+            if len(chunk) == chunk_size:
+                yield get_chunk(chunk, header, float_columns, start)
+                start += len(chunk)
+                chunk = []
+
+        if chunk or not start:
+            yield get_chunk(chunk, header, float_columns, start)
+    finally:
+        workbook.close()
+
+# get the arrow schema of the final product with the columns columns, for 
+# the parquet output written in chunks (see write_output_chunks), so that it
+# doesn't depend on the values of the first chunk, where a column may be
+# empty. The properties are doubles, the year is an integer if year is, and
+# all the other columns (attributes, questions, responses and weights) are 
+# strings.
+def get_output_schema(columns, year):
+    # pyarrow is only needed for the parquet output
+    import pyarrow as pa
+
+    fields = []
+    for v in columns:
+        if v in PROPERTY_COLUMNS:
+            fields.append(pa.field(v, pa.float64()))
+        elif v == 'Year' and isinstance(year, int):
+            fields.append(pa.field(v, pa.int64()))
+        else:
+            fields.append(pa.field(v, pa.string()))
+    return pa.schema(fields)
+
+# write the final product chunk by chunk, as they are produced by the chunks 
+# iterator, so that only one chunk is held in memory at a time. Only the csv
+# and parquet output formats can be written incrementally. The parquet 
+# output is written with the arrow schema schema (see get_output_schema). 
+# Returns the list of written files.
+def write_output_chunks(chunks, output_file, output_format, schema=None):
+    if output_format == "csv":
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(output_file, index=False, header=(i == 0), mode='w' if i == 0 else 'a')
+
+    elif output_format == "parquet":
+        # pyarrow is only needed for the parquet output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # every chunk is written as a row group, cast to the schema. The 
+        # categorical columns of every chunk have their own categories, so 
+        # they are written as plain columns (which parquet still dictionary
+        # encodes), and the values of the string columns are converted to 
+        # text, keeping the empty cells empty.
+        writer = None
+        try:
+            for chunk in chunks:
+                for field in schema:
+                    if pa.types.is_string(field.type):
+                        column = chunk[field.name].astype(object)
+                        chunk[field.name] = column.where(column.isnull(), column.astype(str))
+                table = pa.Table.from_pandas(chunk, preserve_index=False, schema=schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_file, schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    else:
+        raise ValueError("Output format {} can't be written in chunks, expected csv or parquet".format(output_format))
+
+    return [output_file]
 
-    # Anything above the median should get the value of 0, below of 1. If the 
-    # median can be computed (i.e there are odd number of elements in the 
-    # domain), then the median has value of 0.5.
-    def get_count_neg_map(domain_array):
+# =============================================
+# DOMAIN ANALYSIS
+# =============================================
 
-        domain_length = len(domain_array)
-        map_result = {}
+# Anything above the median should get the value of 0, below of 1. If the
+# median can be computed (i.e there are odd number of elements in the
+# domain), then the median has value of 0.5.
+def get_count_neg_map(domain_array):
 
-        # no domain --> return empty map
-        if (domain_length == 0):
-            return map_result
+    domain_length = len(domain_array)
+    map_result = {}
 
-        # below median --> takes on value of 1
-        for i in range(0, int(np.floor(domain_length/2))):            
-            map_result[int(domain_array[i])] = 1
+    # no domain --> return empty map
+    if (domain_length == 0):
+        return map_result
 
-        # above median --> takes on value of 0
-        for i in range(int(np.ceil(domain_length/2)), domain_length):            
-            map_result[int(domain_array[i])] = 0
+    # below median --> takes on value of 1
+    for i in range(0, int(np.floor(domain_length/2))):
+        map_result[int(domain_array[i])] = 1
 
-        # if central point exists --> takes on value of 0.5
-        if domain_length % 2 != 0:            
-            map_result[int(domain_array[int(np.floor(domain_length/2))])] = 0.5
+    # above median --> takes on value of 0
+    for i in range(int(np.ceil(domain_length/2)), domain_length):
+        map_result[int(domain_array[i])] = 0
 
-        return map_result
+    # if central point exists --> takes on value of 0.5
+    if domain_length % 2 != 0:
+        map_result[int(domain_array[int(np.floor(domain_length/2))])] = 0.5
 
-    # Shift all values by the median. The median is computed by taking the 
-    # middle value (averages for even length). Then, all value is offset by the 
-    # value of the median, rounding up to the nearest integer (in magnitude). 
-    def get_normalized_by_median_map(domain_array):
-        
-        map_result = {}
-        domain_length = len(domain_array)
+    return map_result
 
-        if (domain_length == 0):
-            return map_result
+# Shift all values by the median. The median is computed by taking the
+# middle value (averages for even length). Then, all value is offset by the
+# value of the median, rounding up to the nearest integer (in magnitude).
+def get_normalized_by_median_map(domain_array):
 
-        # compute median
-        if domain_length % 2 != 0:
-            midValue = domain_array[int(np.floor(domain_length/2))]
-        else:
-            midValue = float(domain_array[int(domain_length/2) - 1] + domain_array[int(domain_length/2)]) / 2.0
-
-        # go through each element, and compute the difference with the median.
-        # the results are rounded up (in magnitude) to the nearest integer.
-        for i in range(0, domain_length):
-            if (domain_array[i] < midValue):
-                map_result[int(domain_array[i])] = int(np.floor(domain_array[i] - midValue))
-            elif (domain_array[i] > midValue):
-                map_result[int(domain_array[i])] = int(np.ceil(domain_array[i] - midValue))
-            else:
-                map_result[int(domain_array[i])] = 0
+    map_result = {}
+    domain_length = len(domain_array)
 
+    if (domain_length == 0):
         return map_result
 
-    # check if the domain of a particular question is valid. Return
-    # empty if the domain doesn't exist, and prints out warnings if 
-    # there are peculiar value in the domain (discontinuity, negative
-    # values, etc.)
-    def check_domain(domain_array, question):
-        prev = domain_array[0]
-        for item in domain_array[1:]:
-            if (item <= 0):
-                warning_messages.append((WARNING_TAG + "There is a non-positive value in the domain of question {}").format(question))
-                return
-            if (item != prev + 1):
-                warning_messages.append((WARNING_TAG + "There is discontinuity in the domain of question {}").format(question))
-                return
-            prev = item
-
-    # update group_text according to their group name using the group map.
-    # Also, remove '-' at the end of the text if possible.
-    def update_group_text(group_name):
-        temp_text = group_map[group_name]
-        if (temp_text.endswith('-')):
-            temp_text = temp_text[:-1]
-        return temp_text
-
-    # update question_text (removing the group part), and remove special 
-    # characters at the beginning (..., -, &, etc.). The first character
-    # should be a letter or a digit.
-    def update_question_text(question_text, group_text):
-
-        # remove the group_text part from the question
-        if (question_text != group_text):
-            question_text = question_text.replace(group_text, '')
-
-        # remove non-digit or non-letter character at the beginning
-        # of the question text
-        while not (question_text[0].isalpha() or question_text[0].isdigit()):
-            question_text = question_text[1:]
-
-        return question_text
-
-    # find the largest common string from the beginninng of sa and sb
-    def common_start(sa, sb):
-        def _iter():
-            for a, b in zip(sa, sb):
-                if a == b:
-                    yield a
-                else:
-                    return
-
-        return ''.join(_iter())
-
-    # create a labels series that has a corresponding label to
-    # every value in vals. If there is no mapping, then keep 
-    # vals as original
-    def map_value_to_label(vals, column_name):
-        labels = []
-        if column_name in domain_map:
-            curr_map = domain_map[column_name]
-            curr_list = list(curr_map.keys())
-            
-            if not curr_map:
-                return labels
-            else:            
-                for item in vals:
-                    if not item.isdigit() or pd.isnull(item):
-                        labels.append(item)
-                    else:
-                        item = int(item)
-                        if item not in curr_map:                    
-                            print((ERROR_TAG + "Do not find a mapping for the current value {} of column {}. Use original value instead. "
-                                + "Please recheck your mapping file").format(item, column_name))
-                            quit()
-                            # labels.append(item)                     
-                        else:
-                            labels.append(curr_map[item])
-        return labels
-
-    # clean the dataframe for \n, \r and \t characters
-    # Note: for some reason, we have to use str.replace here instead 
-    # of the df.replace function, as it doesn't replace the special 
-    # characters
-    def clean_dataframe(df):
-        for v in df.select_dtypes([np.object]).columns[1:]:
-            df[v] = df[v].astype(str)
-            df[v] = (df[v]).str.replace('\r', ', ')
-            df[v] = (df[v]).str.replace('\t', ', ')
-            df[v] = (df[v]).str.replace('\n', ', ')
-
-    # =============================================
-    # MAIN PROCESS
-    # ============================================= 
+    # compute median
+    if domain_length % 2 != 0:
+        midValue = domain_array[int(np.floor(domain_length/2))]
+    else:
+        midValue = float(domain_array[int(domain_length/2) - 1] + domain_array[int(domain_length/2)]) / 2.0
+
+    # go through each element, and compute the difference with the median.
+    # the results are rounded up (in magnitude) to the nearest integer.
+    for i in range(0, domain_length):
+        if (domain_array[i] < midValue):
+            map_result[int(domain_array[i])] = int(np.floor(domain_array[i] - midValue))
+        elif (domain_array[i] > midValue):
+            map_result[int(domain_array[i])] = int(np.ceil(domain_array[i] - midValue))
+        else:
+            map_result[int(domain_array[i])] = 0
 
-    try:
-        value_df = pd.read_excel(input_filename_v)
-    except Exception as e:
-        print((ERROR_TAG + "Reading error for \"{}\". Exiting.").format(input_filename_v))
-        print("Error log: {}".format(e))
-        quit()
-
-    # obtain all the variable names of the columns
-    varnames = [x for x in value_df.columns if x not in columns_to_ignore]
-
-    # obtain all the labels of the columns
-    varlabels = get_variable_labels(input_filename_questions_to_text, varnames)
-
-    # create a dictionary that map varnames to varlabels
-    varmap = dict(zip(varnames, varlabels))
-
-    # obtain domain map for each question, if applicable
-    domain_map = get_variable_value_domain(input_filename_values_to_labels)
-
-    # transposed the needed columns, basically pivotting right here
-    new_df_cols = [value_df[col] for col in varnames]
-    df = pd.DataFrame(new_df_cols).T
-
-    # create the attributes list here. We also want to rename the attribute  column from their values 
-    # to their labels (texts) in the output file. The renamed columns' name will be stored in 
-    # attributes. We store the original name of the first occurence of any new name in
-    # attribute_rename_backward.
-    attributes = []
-    dont_pivot = []
-    attributes_rename = {}
-    attributes_rename_backward = {}
-
-    for name in tqdm(varnames, desc="Renaming Columns"):
-        if not name.startswith("Q"):        
-            if name in varmap:
-                rename = "{}".format(varmap[name])
+    return map_result
+
+# check if the domain of a particular question is valid. Returns None
+# if it is, or the warning message of the first peculiar value in the
+# domain (discontinuity, negative values, etc.)
+def check_domain(domain_array, question):
+    prev = domain_array[0]
+    for item in domain_array[1:]:
+        if (item <= 0):
+            return "There is a non-positive value in the domain of question {}".format(question)
+        if (item != prev + 1):
+            return "There is discontinuity in the domain of question {}".format(question)
+        prev = item
+    return None
+
+# update group_text according to its group, as found in the group map.
+# Remove '-' at the end of the text if possible.
+def update_group_text(group_text):
+    if (group_text.endswith('-')):
+        group_text = group_text[:-1]
+    return group_text
+
+# update question_text (removing the group part), and remove special
+# characters at the beginning (..., -, &, etc.). The first character
+# should be a letter or a digit.
+def update_question_text(question_text, group_text):
+
+    # remove the group_text part from the question
+    if (question_text != group_text):
+        question_text = question_text.replace(group_text, '')
+
+    # remove non-digit or non-letter character at the beginning
+    # of the question text
+    while not (question_text[0].isalpha() or question_text[0].isdigit()):
+        question_text = question_text[1:]
+
+    return question_text
+
+# find the largest common string from the beginninng of sa and sb
+def common_start(sa, sb):
+    def _iter():
+        for a, b in zip(sa, sb):
+            if a == b:
+                yield a
+            else:
+                return
 
-                # if there is a duplicate in the label of a name
-                if rename in attributes_rename_backward:
+    return ''.join(_iter())
+
+# compile the domain table into a single lookup table: a series indexed by
+# (question id, response value) pairs, with the response text as values.
+# It is built once, so that the responses of every question can be
+# resolved with vectorized lookups instead of one dict access per response.
+def compile_domain_table(table):
+    return pd.Series(table["Label"].to_numpy(dtype=object), dtype=object,
+        index=pd.MultiIndex.from_arrays([table["Question"].values, table["Value"].values],
+        names=["Question", "Value"]))
+
+# compile the count negative and normalized by median maps of every
+# question of the question dimension table into two integer-indexed
+# lookup arrays. The maps
+# are laid out one after another, each one covering the range from the
+# smallest to the largest value of its question's domain, with NaN for
+# the values that are not part of the domain. The bounds data frame holds
+# the offset of each question's map in the arrays and its value range.
+def compile_property_tables(question_dimension):
+    bounds = []
+    negative_tables = []
+    normalize_tables = []
+    offset = 0
+
+    for question, negative_map, normalize_map in zip(question_dimension.index,
+            question_dimension['Property - Count Negative Map'],
+            question_dimension['Property - Normalized By Median Map']):
+        if not negative_map:
+            continue
+
+        low = min(negative_map)
+        high = max(negative_map)
+
+        negative_table = np.full(high - low + 1, np.nan)
+        negative_table[np.array(list(negative_map.keys())) - low] = list(negative_map.values())
+        negative_tables.append(negative_table)
+
+        normalize_table = np.full(high - low + 1, np.nan)
+        normalize_table[np.array(list(normalize_map.keys())) - low] = list(normalize_map.values())
+        normalize_tables.append(normalize_table)
+
+        bounds.append((question, offset, low, high))
+        offset += high - low + 1
+
+    bounds = pd.DataFrame([bound[1:] for bound in bounds], columns=['offset', 'low', 'high'],
+        index=[bound[0] for bound in bounds], dtype=int)
+
+    if not negative_tables:
+        return bounds, np.array([]), np.array([])
+
+    return bounds, np.concatenate(negative_tables), np.concatenate(normalize_tables)
+
+# compute the count negative and normalized by median of every response
+# in vals in a single pass, where questions holds the question id of each
+# response. Responses without a numeric value (e.g. "No response"), or of
+# a question without domain, are NaN, and values that are not in the 
+# property maps of their question (outside of the domain, or excluded from
+# the domain analysis) are kept as is, unless mapped_only is True, in which
+# case they are NaN too.
+def map_values_to_properties(questions, vals, property_tables, mapped_only=False):
+    bounds, negative_table, normalize_table = property_tables
+
+    count_negative = np.full(len(vals), np.nan)
+    normalized_by_median = np.full(len(vals), np.nan)
+
+    positions = bounds.index.get_indexer(questions)
+    rows = np.flatnonzero(positions >= 0)
+
+    numeric = pd.to_numeric(pd.Series(np.asarray(vals, dtype=object)[rows]), errors='coerce').values.astype(float)
+    valid = ~np.isnan(numeric)
+    rows = rows[valid]
+    positions = positions[rows]
+    numeric = numeric[valid].astype(int)
+
+    low = bounds['low'].values[positions]
+    high = bounds['high'].values[positions]
+    in_domain = (numeric >= low) & (numeric <= high)
+    lookup = (bounds['offset'].values[positions] + numeric - low)[in_domain]
+
+    for table, result in ((negative_table, count_negative), (normalize_table, normalized_by_median)):
+        mapped = np.full(len(numeric), np.nan)
+        mapped[in_domain] = table[lookup]
+        found = ~np.isnan(mapped)
+
+        properties = np.full(len(numeric), np.nan) if mapped_only else numeric.astype(float)
+        properties[found] = mapped[found]
+        result[rows] = properties
+
+    return count_negative, normalized_by_median
+
+# find the answered responses among the responses vals and their texts
+# labels: the responses with a text and a value that is not blank.
+# Returns a boolean array.
+def get_answered(vals, labels):
+    answered = pd.notnull(labels)
+    blank = pd.Series(np.asarray(vals, dtype=object)[answered]).str.strip() == ''
+    answered[np.flatnonzero(answered)[blank.values]] = False
+    return answered
 
-                    # then add an extension that indicates its original name to the new name
-                    newname = "{} ({})".format(rename, name)
+# =============================================
+# SURVEY PIVOTER
+# =============================================
+# SurveyPivoter pivots the values of a survey, held in a data frame, into
+# the final product, also returned as a data frame. The labels and domains
+# of the survey are parsed and compiled once, when it is created, and the
+# column plan, question metadata and property tables are computed once per
+# set of value columns, so that many data frames (e.g. subsets of
+# respondents) can be pivoted against the same mappings. It doesn't write
+# any file, raises exceptions on errors instead of exiting, and collects
+# its warnings in warning_messages.
+
+# error in the inputs of a survey
+class SurveyPivoterError(Exception):
+    pass
+
+# error raised when the validation of the inputs fails. report is the
+# validation report, see SurveyPivoter.get_validation_report
+class SurveyValidationError(SurveyPivoterError):
+    def __init__(self, message, report):
+        super(SurveyValidationError, self).__init__(message)
+        self.report = report
+
+    # keep the report when the error is sent back from a worker process
+    def __reduce__(self):
+        return (self.__class__, (str(self), self.report))
+
+class SurveyPivoter(object):
+
+    # config is a dict with the settings of a config file. year, survey_name,
+    # weight_col, both_attribute_and_question, columns_to_ignore,
+    # exclude_from_domain_analysis and common_string_threshold are required.
+    # varmap maps the columns' name to their textual label, and domain_map
+    # holds the domain of every question, either as a map of maps or as a
+    # domain table (see read_value_domain). They are read from the
+    # input_filename_questions_to_text and input_filename_values_to_labels
+    # files of the config if they are not given.
+    def __init__(self, config, varmap=None, domain_map=None):
+        try:
+            self.year = config['year']
+            self.survey_name = config['survey_name']
+            self.weight_col = config['weight_col']
+            self.both_attribute_and_question = config['both_attribute_and_question']
+            self.columns_to_ignore = config['columns_to_ignore']
+            self.exclude_from_domain_analysis = [item.lower() for item in config['exclude_from_domain_analysis']]
+            self.common_string_threshold = config['common_string_threshold']
+
+            if varmap is None:
+                varmap = read_variable_labels(config['input_filename_questions_to_text'])
+            if domain_map is None:
+                domain_map = read_value_domain(config['input_filename_values_to_labels'])
+        except KeyError as e:
+            raise KeyError("Expected variable {} in config but it wasn't found".format(e))
 
-                    # update the first occurrence of the new name. If this process has 
-                    # already happened, then first_occ_name should return an empty string
-                    # so we only do the process once
-                    first_occ_name = attributes_rename_backward[rename]
-                    if first_occ_name:
-                        index = attributes.index(rename)
-                        first_occ_rename = "{} ({})".format(rename, first_occ_name)
-                        attributes[index] = first_occ_rename                    
-                        attributes_rename[first_occ_name] = first_occ_rename
+        self.varmap = varmap
+        self.warning_messages = []
+        self.missing_labels = []
 
-                        # change the original name that corresponds to the first occurence of new name
-                        # to empty string to indicate that we shouldn't do this updating process more 
-                        # than one                    
-                        attributes_rename_backward[rename] = ""
+        # the domains are kept as a table without duplicated keys (only the
+        # first one is kept, the other ones are reported by the validation),
+        # as a map of maps, and compiled into a lookup table of response texts
+        if isinstance(domain_map, pd.DataFrame):
+            domain_frame = domain_map
+        else:
+            domain_frame = get_domain_table_from_map(domain_map)
 
-                    rename = newname
+        duplicated = domain_frame.groupby(["Question", "Value"], sort=False).cumcount().values > 0
+        self.duplicated_domain_keys = list(zip(domain_frame["Question"].values[duplicated].tolist(),
+            domain_frame["Value"].values[duplicated].tolist()))
 
-                else:
-                    # save the original name that corresponds to the first occurence of new name. 
-                    # This value will be changed to empty string if we ever encounter this new 
-                    # name again.
-                    attributes_rename_backward[rename] = name
-                
-                attributes.append(rename)
-                attributes_rename[name] = rename
+        self.domain_frame = domain_frame[~duplicated].reset_index(drop=True)
+        self.domain_map = get_domain_map_from_table(self.domain_frame)
+        self.domain_table = compile_domain_table(self.domain_frame).replace("#NULL!", "No response")
+        self.domain_questions = pd.Index(self.domain_frame["Question"].unique())
 
-            # we do not pivot the attribute columns
-            # unless we want certain columns to be pivoted as well
-            if not name in both_attribute_and_question:
-                dont_pivot.append(name)
-
-    # rename the columns that are used as attributes
-    df.rename(columns=attributes_rename, inplace=True)
-    df_cols = df.columns
-
-    # If weight column specified above doesn't exist, 
-    # create it and set all weights to 1
-    if weight_col not in df_cols:
-        df[weight_col] = 1
-
-    clean_dataframe(df)
-
-    # identify the necessary columns to keep as column as well. If the columns
-    # have numerical/categorical data, it will be suffixed with "_l"
-    attribute_col = []
-    for v in tqdm(attributes, desc="Adding attributes"):
-        if v not in df_cols:
-            # print((WARNING_TAG + "Merged data file is missing column {}, and no replacement was found").format(v))
-            warning_messages.append((WARNING_TAG + "Merged data file is missing column {}, and no replacement was found").format(v))
-        else:
-            attribute_col.append(v)
+        # column plans, by columns of the value data frames
+        self.column_plans = {}
 
-    # flush warning messages
-    for warning in warning_messages:
-        print(warning)
-    warning_messages[:] = []
+    # get the labels (text) for columns' variables, in the same order as
+    # varnames. Columns without a label keep their name, with a warning.
+    # Returns the list of labels, and the list of columns without a label.
+    def get_variable_labels(self, varnames):
+        label_list = []
+        missing_variable_labels = []
 
-    # construct the new data frame with the right format        
-    dataframes = []
-    group_map = {}
+        # going through the relevant column names, and find the right textual
+        # label for it
+        for name in varnames:
+            if name in self.varmap and not pd.isnull(self.varmap[name]):
+                label_list.append(self.varmap[name])
+            else:
+                self.warning_messages.append((WARNING_TAG +
+                    "Missing label for value \"{}\". Use original value instead").format(name))
+                label_list.append(name)
+                missing_variable_labels.append(name)
+
+        return label_list, missing_variable_labels
+
+    # get the column plan of the value data frames with the columns columns,
+    # built in a single pass over the columns, with dict and set lookups only,
+    # so that it stays linear in the number of columns. Every column is
+    # classified as ignored (in columns_to_ignore), question (its name starts
+    # with "Q"), attribute, or both (an attribute of
+    # both_attribute_and_question, also pivoted as a question). The plan is a
+    # dict with the class of every column, the columns that are not ignored
+    # (varnames), their label (varmap), the attributes and their new name, the
+    # attribute columns of the output, the columns to pivot and the text of
+    # each of them. The plan is computed once per set of columns, and also
+    # holds the question dimension and property tables of its questions once
+    # they are needed.
+    def get_column_plan(self, columns):
+        key = tuple(columns)
+        if key in self.column_plans:
+            return self.column_plans[key]
+
+        columns_to_ignore = set(self.columns_to_ignore)
+        both_attribute_and_question = set(self.both_attribute_and_question)
+
+        column_classes = OrderedDict()
+        for name in columns:
+            if name in columns_to_ignore:
+                column_classes[name] = 'ignore'
+            elif name.startswith("Q"):
+                column_classes[name] = 'question'
+            elif name in both_attribute_and_question:
+                column_classes[name] = 'both'
+            else:
+                column_classes[name] = 'attribute'
+
+        varnames = [name for name, column_class in column_classes.items() if column_class != 'ignore']
+        varlabels, missing_variable_labels = self.get_variable_labels(varnames)
+
+        # create a dictionary that map varnames to varlabels
+        varmap = dict(zip(varnames, varlabels))
+
+        # the attribute columns are renamed from their values to their labels
+        # (texts) in the output file. Attributes sharing a label get their
+        # original name as an extension, e.g. "Name (V1)" and "Name (V3)": the
+        # first attribute with a label is only renamed again once a second one
+        # shows up. first_attributes holds the position (in attributes) and the
+        # original name of the first attribute of every label, or None once it
+        # has been renamed again.
+        attributes = []
+        attributes_rename = {}
+        first_attributes = {}
+
+        # the columns to pivot, using the renamed value for pivoted
+        # attributes, and their text before grouping (the label of a
+        # question, the new name of an attribute)
+        pivot_cols = []
+        pivot_texts = []
 
-    # print(attribute_col)
+        for name in varnames:
+            column_class = column_classes[name]
 
-    for v in tqdm(varnames, desc="Pivoting"):
-        if v not in dont_pivot:
+            if column_class != 'question':
+                rename = "{}".format(varmap[name])
 
-            # order of columns
-            pivoted = pd.DataFrame(columns = ['Survey Name', 'Year'] + attribute_col +
-                                   ['Question - Group ID', 'Question - Group Text', 'Question - ID', 
-                                   'Question - Text', 'Response - Value', 'Response - Text', 
-                                   'Property - Count Negative', 'Property - Normalized By Median', 
-                                   'Property - Weight'])
+                # if there is a duplicate in the label of a name
+                if rename in first_attributes:
+                    first_attribute = first_attributes[rename]
+                    if first_attribute is not None:
+                        index, first_name = first_attribute
+                        attributes[index] = "{} ({})".format(rename, first_name)
+                        attributes_rename[first_name] = attributes[index]
+                        first_attributes[rename] = None
+
+                    rename = "{} ({})".format(rename, name)
+                else:
+                    first_attributes[rename] = (len(attributes), name)
 
-            # change v to be the renamed value if v is a pivoted attribute
-            if v in both_attribute_and_question:
-                v = attributes_rename[v]
+                attributes.append(rename)
+                attributes_rename[name] = rename
 
-            vals = df[v]
+            if column_class != 'attribute':
+                pivot_cols.append(name)
 
-            temp_list = map_value_to_label(vals, v)
-            labels = vals if not temp_list else pd.Series(temp_list)
+        # the renamed attributes are only known once all the columns have been
+        # seen
+        for i, name in enumerate(pivot_cols):
+            if column_classes[name] == 'both':
+                pivot_cols[i] = attributes_rename[name]
+                pivot_texts.append(attributes_rename[name])
+            else:
+                pivot_texts.append(varmap[name])
 
-            pivoted['Response - Value'] = vals
-            pivoted['Response - Text'] = labels
+        # the columns of the value data frames once prepared, see prepare_values
+        df_cols = set(attributes_rename.get(name, name) for name in varnames) | set([self.weight_col])
 
-            if v in domain_map:                
-                domain = domain_map[v]
+        # identify the necessary columns to keep as column as well
+        attribute_col = []
+        for v in attributes:
+            if v not in df_cols:
+                self.warning_messages.append((WARNING_TAG +
+                    "Merged data file is missing column {}, and no replacement was found").format(v))
             else:
-                domain = {}
+                attribute_col.append(v)
+
+        plan = {
+            'columns': column_classes,
+            'varnames': varnames,
+            'varmap': varmap,
+            'missing_variable_labels': missing_variable_labels,
+            'attributes': attributes,
+            'attributes_rename': attributes_rename,
+            'attribute_col': attribute_col,
+            'pivot_cols': pivot_cols,
+            'pivot_texts': pivot_texts,
+            'question_dimension': None,
+            'property_tables': None
+        }
+        self.column_plans[key] = plan
+        return plan
+
+    # rename the columns of a value data frame that are used as attributes,
+    # add the weight column if needed, and replace the "#NULL!" values, in
+    # place. The value data frame is expected to be cleaned already (see
+    # get_value_frame).
+    def prepare_values(self, df, plan):
+        df.rename(columns=plan['attributes_rename'], inplace=True)
+
+        # If weight column specified above doesn't exist,
+        # create it and set all weights to 1
+        if self.weight_col not in df.columns:
+            df[self.weight_col] = 1
+
+        replace_null_values(df)
+        return df
+
+    # obtain the sorted values of the domain of a question that are part of
+    # the domain analysis. Responses specified by the user in
+    # exclude_from_domain_analysis are not part of it.
+    def get_domain_array(self, question):
+        if question in self.domain_map:
+            domain = self.domain_map[question]
+        else:
+            domain = {}
 
-            # make sure the exclude certain responses specified by the user from the 
-            # domain analysis
-            format_domain = {k:v for k,v in domain.items() if v.lower() not in exclude_from_domain_analysis}
+        # make sure the exclude certain responses specified by the user from the
+        # domain analysis
+        format_domain = {k:v for k,v in domain.items() if v.lower() not in self.exclude_from_domain_analysis}
 
-            # convert the domain to a sorted domain_array
-            domain_array = list(format_domain.keys())
+        # convert the domain to a sorted domain_array
+        return sorted(format_domain.keys())
 
-            # if a domain exists
-            if domain_array:
-                domain_array.sort()
-                check_domain(domain_array, v)
-            
-                negative_map = get_count_neg_map(domain_array)
-                normalize_map = get_normalized_by_median_map(domain_array)
-                
-                pivoted.count_negative = 0
-                pivoted.normalized_by_median = 0
+    # obtain the count negative and normalized by median maps of a question.
+    # Both maps are empty if the question has no domain.
+    def get_property_maps(self, question):
+        domain_array = self.get_domain_array(question)
 
-                if len(negative_map) > 0:
-                    pivoted['Property - Count Negative'] = (vals.astype(float)).dropna().astype(int, casting="safe").replace(negative_map)
+        # if a domain doesn't exist
+        if not domain_array:
+            return {}, {}
 
-                if len(normalize_map) > 0:
-                    pivoted['Property - Normalized By Median'] = (vals.astype(float)).dropna().astype(int, casting="safe").replace(normalize_map)
+        return get_count_neg_map(domain_array), get_normalized_by_median_map(domain_array)
 
-            pivoted['Survey Name'] = survey_name
-            pivoted['Year'] = year
+    # get the question dimension table of the questions of a column plan: the
+    # metadata of every pivoted question, resolved once per question in the
+    # order of the plan's pivot_cols. It holds the group id, the group text,
+    # the question text, the domain and the count negative and normalized by
+    # median maps of each question. The group text of a group depends on all
+    # of its members, so the texts are only finalized after every question
+    # has been seen. The result is a data frame indexed by question id.
+    def get_question_dimension(self, plan):
+        if plan['question_dimension'] is not None:
+            return plan['question_dimension']
 
-            question_text = v if v in attributes else varmap[v]
+        pivot_cols = plan['pivot_cols']
+        question_texts = []
+        group_names = []
+        group_map = {}
 
-            if (question_text == "Q1_TEXT"):
-                print(v)
+        for v, question_text in zip(pivot_cols, plan['pivot_texts']):
 
             # create group if there is a '_'
             if '_' in v:
@@ -476,75 +1239,1216 @@ def main():
             else:
                 group_name_var = v
 
-            # if there is no mapping in group_map, implying that this is the first 
+            # if there is no mapping in group_map, implying that this is the first
             # occurrence of group_name
             if group_name_var not in group_map:
                 group_map[group_name_var] = question_text
-                group_name_text = question_text
 
             # there is a mapping, so update the mapped value string by finding
-            # the most common string with the current value. If the common string 
+            # the most common string with the current value. If the common string
             # is less than threshold number of characters, then use group_name_var
             # as the text
             else:
                 common_string = common_start(question_text, group_map[group_name_var])
-                if (len(common_string) >= common_string_threshold):
-                    group_name_text = common_string
+                if (len(common_string) >= self.common_string_threshold):
+                    group_map[group_name_var] = common_string
                 else:
-                    group_name_text = group_name_var
+                    group_map[group_name_var] = group_name_var
+
+            question_texts.append(question_text)
+            group_names.append(group_name_var)
+
+        group_texts = [update_group_text(group_map[group_name]) for group_name in group_names]
+        property_maps = [self.get_property_maps(v) for v in pivot_cols]
+
+        question_dimension = pd.DataFrame({
+            'Question - Group ID': group_names,
+            'Question - Group Text': group_texts,
+            'Question - Text': [update_question_text(question_text, group_text)
+                for question_text, group_text in zip(question_texts, group_texts)],
+            'Question - Domain': [self.domain_map.get(v, {}) for v in pivot_cols],
+            'Property - Count Negative Map': [maps[0] for maps in property_maps],
+            'Property - Normalized By Median Map': [maps[1] for maps in property_maps]
+        }, index=pivot_cols, columns=QUESTION_DIMENSION_COLUMNS)
+        replace_null_values(question_dimension)
+
+        plan['question_dimension'] = question_dimension
+        return question_dimension
+
+    # get the property tables of the questions of a column plan, see
+    # compile_property_tables
+    def get_property_tables(self, plan):
+        if plan['property_tables'] is None:
+            plan['property_tables'] = compile_property_tables(self.get_question_dimension(plan))
+        return plan['property_tables']
+
+    # resolve the response text of every response in vals, where questions
+    # holds the question id of each response. Only numeric responses of
+    # questions with a domain are mapped, and any other response keeps its
+    # original value. Responses that have no mapping in their question's
+    # domain also keep their original value, and are recorded in
+    # missing_labels so that they can be reported all at once.
+    def map_values_to_labels(self, questions, vals):
+        questions = np.asarray(questions, dtype=object)
+        vals = pd.Series(np.asarray(vals, dtype=object))
+        labels = vals.values.copy()
+
+        mapped = self.domain_questions.get_indexer(questions) >= 0
+        mapped &= vals.astype(str).str.isdigit().values
+
+        if not mapped.any():
+            return labels
+
+        keys = pd.MultiIndex.from_arrays([questions[mapped], vals[mapped].astype(int).values])
+        positions = self.domain_table.index.get_indexer(keys)
+        found = positions >= 0
+
+        mapped_labels = vals[mapped].values
+        mapped_labels[found] = self.domain_table.values.take(positions[found])
+        labels[mapped] = mapped_labels
+
+        if not found.all():
+            self.missing_labels.extend(keys[~found].unique())
 
-                group_map[group_name_var] = group_name_text
+        return labels
 
-            pivoted['Question - ID'] = v
-            pivoted['Question - Text'] = question_text
-            pivoted['Question - Group ID'] = group_name_var
-            pivoted['Question - Group Text'] = group_name_text
-            pivoted['Property - Weight'] = df[[weight_col]]
-            pivoted[attribute_col] = df[attribute_col]
-            dataframes.append(pivoted)
+    # resolve the distinct values (the categories) of the question columns
+    # questions of the prepared value data frame df, once per value rather
+    # than once per response: their text, and their count negative and
+    # normalized by median properties. Returns a data frame of the resolved
+    # values, one row per category of every question, in order of questions,
+    # and the codes of the responses of all the questions, one question after
+    # the other, as row numbers of that data frame. The code of an empty or
+    # unanswered response is -1.
+    def get_responses(self, df, questions, plan):
+        categories = [df[v].cat.categories for v in questions]
+        sizes = [len(category) for category in categories]
+        offsets = np.cumsum([0] + sizes[:-1])
+
+        question_ids = np.repeat(np.array(questions, dtype=object), sizes)
+        response_values = np.concatenate([np.array([], dtype=object)] +
+            [np.asarray(category, dtype=object) for category in categories])
+        response_texts = self.map_values_to_labels(question_ids, response_values)
+        count_negative, normalized_by_median = map_values_to_properties(question_ids, response_values,
+            self.get_property_tables(plan))
+
+        responses = pd.DataFrame({
+            'Question - ID': question_ids,
+            'Response - Value': response_values,
+            'Response - Text': response_texts,
+            'Property - Count Negative': count_negative,
+            'Property - Normalized By Median': normalized_by_median
+        })
+
+        # shift the codes of every question by the offset of its categories,
+        # and only keep the codes of the answered values
+        codes = np.concatenate([np.array([], dtype=int)] + [df[v].cat.codes.values.astype(int) for v in questions])
+        valid = codes >= 0
+        codes[valid] += np.repeat(offsets, len(df))[valid]
+        valid[valid] = get_answered(response_values, response_texts)[codes[valid]]
+        codes[~valid] = -1
+
+        return responses, codes
+
+    # pivot a single question of the loop engine, using the question
+    # dimension table resolved beforehand for all questions, so that the
+    # questions can be pivoted independently of each other. The responses 
+    # of the question are resolved (see get_responses), unless resolved 
+    # holds them already.
+    def pivot_question(self, df, v, plan, resolved=None):
+        question = self.get_question_dimension(plan).loc[v]
+        attribute_col = plan['attribute_col']
+
+        # only keep the answered responses
+        responses, codes = resolved if resolved is not None else self.get_responses(df, [v], plan)
+        answered = codes >= 0
+
+        pivoted = responses.take(codes[answered])
+        pivoted.index = df.index[answered]
+
+        pivoted['Survey Name'] = self.survey_name
+        pivoted['Year'] = self.year
+        pivoted['Question - Text'] = question['Question - Text']
+        pivoted['Question - Group ID'] = question['Question - Group ID']
+        pivoted['Question - Group Text'] = question['Question - Group Text']
+        pivoted['Property - Weight'] = df[self.weight_col].values[answered]
+        for a in attribute_col:
+            pivoted[a] = df[a].values[answered]
+
+        # order of columns
+        return pivoted[['Survey Name', 'Year'] + attribute_col + PIVOTED_COLUMNS]
+
+    # pivot every question in pivot_cols at once. The codes of the value
+    # columns of all the questions are reshaped into one long array in a
+    # single pass, ordered by question and then by respondent, the same as
+    # the loop engine, and the long data frame is taken from the resolved
+    # values of the questions (see get_responses). The question metadata is
+    # joined on afterward. The question dimension and property tables are
+    # computed once per column plan (see get_question_dimension and
+    # get_property_tables), so that they are reused between chunks of
+    # respondents.
+    def melt_pivot(self, df, pivot_cols, plan):
+        attribute_col = plan['attribute_col']
+
+        # only keep the answered responses, and the respondent of each of them
+        responses, codes = self.get_responses(df, pivot_cols, plan)
+        answered = codes >= 0
+        respondents = np.tile(np.arange(len(df)), len(pivot_cols))[answered]
+
+        pivoted = responses.take(codes[answered])
+        pivoted.index = df.index.values.take(respondents)
+        pivoted['Survey Name'] = self.survey_name
+        pivoted['Year'] = self.year
+        pivoted['Property - Weight'] = df[self.weight_col].values.take(respondents)
+
+        for v in attribute_col:
+            pivoted[v] = df[v].values.take(respondents)
+
+        pivoted = pivoted.join(self.get_question_dimension(plan)[['Question - Group ID',
+            'Question - Group Text', 'Question - Text']], on='Question - ID')
+
+        # order of columns
+        return pivoted[['Survey Name', 'Year'] + attribute_col + PIVOTED_COLUMNS]
+
+    # pivot the questions pivot_order of the prepared value data frame df,
+    # with the "loop" or "melt" engine. The loop engine resolves the 
+    # responses of the questions with a pool of processes if workers > 1 
+    # (see resolve_question_batch), and records the time of every question in
+    # profile, if any. Returns the list of pivoted data frames, in the order
+    # of pivot_order.
+    def pivot_questions(self, df, plan, pivot_order, engine="melt", workers=1, profile=None,
+                        show_progress=False):
+
+        # pivot a single question with the loop engine, recording its time in
+        # the profile, if any, along with the time it took to resolve its
+        # responses in a worker process
+        def pivot_profiled_question(v, resolved=None, resolve_time=0.0):
+            question_start = time.time()
+            pivoted = self.pivot_question(df, v, plan, resolved)
+            if profile is not None:
+                profile['questions'].append({'question': v, 'rows': len(pivoted),
+                    'wall_time': time.time() - question_start + resolve_time})
+            return pivoted
+
+        if not pivot_order:
+            return []
+
+        if engine == "melt":
+            return [self.melt_pivot(df, pivot_order, plan)]
+
+        # the metadata of the questions is resolved once, before pivoting
+        self.get_question_dimension(plan)
+        self.get_property_tables(plan)
+
+        if workers > 1:
+            # resolving the responses of a question holds the GIL, so they are
+            # resolved by a pool of processes, in batches of consecutive 
+            # questions. Every batch is sent with the value columns of its
+            # questions only (small integer codes into their categories), and
+            # only the resolved categories and the codes of the responses are
+            # sent back. The data frames of the questions are then built in 
+            # pivot order.
+            batches = [batch.tolist() for batch in np.array_split(np.array(pivot_order, dtype=object),
+                min(workers * 4, len(pivot_order)))]
+
+            dataframes = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(resolve_question_batch, self, df[batch], plan, batch)
+                    for batch in batches]
+                if show_progress:
+                    futures = progress(futures, desc="Pivoting")
+                for batch, future in zip(batches, futures):
+                    resolved, resolve_times, missing_labels = future.result()
+                    self.missing_labels.extend(missing_labels)
+                    for v, responses, resolve_time in zip(batch, resolved, resolve_times):
+                        dataframes.append(pivot_profiled_question(v, responses, resolve_time))
+            return dataframes
+
+        if show_progress:
+            pivot_order = progress(pivot_order, desc="Pivoting")
+        return [pivot_profiled_question(v) for v in pivot_order]
+
+    # count the responses of the prepared value data frame df that don't
+    # have a mapping in their question's domain, with a single vectorized
+    # lookup of the distinct numeric values of all the pivoted questions that
+    # have a domain, the same as map_values_to_labels, and the number of
+    # responses of each value. Returns a series of counts indexed by
+    # (question, value).
+    def count_missing_labels(self, df, plan):
+        question_ids = []
+        vals = []
+        counts = [np.array([], dtype=int)]
+
+        for v in plan['pivot_cols']:
+            if v in self.domain_questions:
+                categories = df[v].cat.categories
+                codes = df[v].cat.codes.values
+                question_ids.extend([v] * len(categories))
+                vals.extend(categories)
+                counts.append(np.bincount(codes[codes >= 0], minlength=len(categories)))
+
+        question_ids = np.array(question_ids, dtype=object)
+        vals = pd.Series(vals, dtype=object)
+        counts = np.concatenate(counts)
+        numeric = vals.astype(str).str.isdigit().values
+
+        keys = pd.MultiIndex.from_arrays([question_ids[numeric], vals[numeric].astype(int).values],
+            names=["Question", "Value"])
+        missing = self.domain_table.index.get_indexer(keys) < 0
+        return pd.Series(counts[numeric][missing], index=keys[missing], dtype=int).groupby(
+            level=["Question", "Value"], sort=False).sum()
+
+    # build the validation report of the inputs of a column plan, one row per
+    # problem. The errors stop the pivot: responses without a mapping in
+    # their question's domain (counted by count_missing_labels) and
+    # duplicated keys in the value to label file. The warnings don't:
+    # questions with a peculiar domain, and columns without a label.
+    def get_validation_report(self, plan, missing_counts):
+        problems = []
+
+        for question, value in self.duplicated_domain_keys:
+            problems.append(('error', 'duplicated_domain_key', question, value, None,
+                "Duplicated labels for key {} in question {}. Please resolve the issue!".format(value, question)))
+
+        for (question, value), count in missing_counts.items():
+            problems.append(('error', 'missing_response_label', question, value, count,
+                ("Do not find a mapping for the current value {} of column {}. "
+                + "Please recheck your mapping file").format(value, question)))
+
+        for v in plan['pivot_cols']:
+            domain_array = self.get_domain_array(v)
+            message = check_domain(domain_array, v) if domain_array else None
+            if message:
+                problems.append(('warning', 'domain', v, None, None, message))
+
+        for name in plan['missing_variable_labels']:
+            problems.append(('warning', 'missing_variable_label', name, None, None,
+                "Missing label for value \"{}\". Use original value instead".format(name)))
+
+        return pd.DataFrame(problems, columns=VALIDATION_COLUMNS, dtype=object)
+
+    # validate the prepared value data frame df against the domains. Raises
+    # a SurveyValidationError if there is any error, and returns the
+    # validation report otherwise.
+    def validate(self, df, plan):
+        report = self.get_validation_report(plan, self.count_missing_labels(df, plan))
+        errors = report[report['Severity'] == 'error']
+        if len(errors):
+            raise SurveyValidationError("{} error(s) in the inputs: {}".format(len(errors),
+                " ".join(errors['Message'])), report)
+        return report
+
+    # concatenate the pivoted questions into the final product. The
+    # unanswered responses were already left out and the "#NULL!" values
+    # replaced while pivoting, and the questions were pivoted in order.
+    def get_final_product(self, dataframes, plan):
+        attribute_col = plan['attribute_col']
+        final_product = pd.concat(dataframes)
+        final_product.rename(index=str, \
+            columns=dict(zip(attribute_col, list(map(lambda x: "Attribute - {}".format(x), attribute_col)))),
+            inplace=True)
+        return final_product
+
+    # build the respondent dimension table of the star schema output, which
+    # holds everything that is constant per respondent, with the same
+    # respondent id as the final product
+    def get_respondent_dimension(self, df, plan):
+        attribute_col = plan['attribute_col']
+        respondent_dimension = df[attribute_col].rename(
+            columns=dict(zip(attribute_col, list(map(lambda x: "Attribute - {}".format(x), attribute_col)))))
+        respondent_dimension.insert(0, 'Year', self.year)
+        respondent_dimension.insert(0, 'Survey Name', self.survey_name)
+        respondent_dimension.insert(0, 'Respondent - ID', df.index.map(str))
+        respondent_dimension['Property - Weight'] = df[self.weight_col]
+        return respondent_dimension
+
+    # pivot the values of the survey in value_df, as read from a values file
+    # (one row per respondent, one column per variable), and return the
+    # final product. The inputs are validated first, and the whole data
+    # frame is pivoted with the "loop" or "melt" engine (see
+    # pivot_questions). Raises a SurveyValidationError if the validation
+    # fails.
+    def pivot(self, value_df, engine="melt", workers=1):
+        plan = self.get_column_plan(value_df.columns)
+        df = self.prepare_values(get_value_frame(value_df, plan['varnames']), plan)
+        self.validate(df, plan)
+
+        self.missing_labels = []
+        dataframes = self.pivot_questions(df, plan, sorted(plan['pivot_cols']), engine, workers)
+        if self.missing_labels:
+            raise SurveyPivoterError("{} response value(s) without a mapping".format(len(self.missing_labels)))
+
+        return self.get_final_product(dataframes, plan)
+
+# resolve the responses of the batch of questions of the prepared value data
+# frame df (see SurveyPivoter.get_responses), in a worker process of 
+# SurveyPivoter.pivot_questions. Returns the resolved responses and codes of
+# every question, the time it took to resolve them, and the responses 
+# without a mapping (see SurveyPivoter.map_values_to_labels).
+def resolve_question_batch(pivoter, df, plan, questions):
+    pivoter.missing_labels = []
+    resolved = []
+    resolve_times = []
+    for v in questions:
+        resolve_start = time.time()
+        resolved.append(pivoter.get_responses(df, [v], plan))
+        resolve_times.append(time.time() - resolve_start)
+    return resolved, resolve_times, pivoter.missing_labels
 
-    # parse through the data frame one more time to update group_text
-    for row in dataframes:
-        row['Question - Group Text'] = row['Question - Group ID'].apply(update_group_text)
+# =============================================
+# INPUT FILES
+# =============================================
+
+# show a progress bar over iterable, with tqdm, which is only imported once
+# a progress bar is shown
+def progress(iterable, **kwargs):
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
+
+# parse a yaml config file into a dict
+def read_config(config_file):
+    import yaml
 
-    # second parse through the data frame to update question text
-    for row in dataframes:
-        question_text = row['Question - Text']
-        group_text = row['Question - Group Text']
+    with open(config_file, 'r') as ymlfile:
+        return yaml.safe_load(ymlfile)
 
-        row['Question - Text'] = question_text.apply(update_question_text, args=(group_text[0],))
+# read an input xlsx file into a data frame, raising a SurveyPivoterError if
+# it can't be read
+def read_input_file(filename):
+    try:
+        return pd.read_excel(filename)
+    except Exception as e:
+        raise SurveyPivoterError("Reading error for \"{}\". Error log: {}".format(filename, e))
+
+# read the question to text file: a map from the columns' name (the Name
+# column) to their textual label (the Label column)
+def read_variable_labels(filename):
+    l_v_df = read_input_file(filename)
+
+    # clean data frame for \t, \r and \n symbols
+    clean_dataframe(l_v_df)
+
+    # create a map from Name column to Label column
+    return dict(zip(l_v_df["Name"], l_v_df["Label"]))
+
+# read the value to label file: the domain of every question, as a table
+# with one row per (question, response value) pair: the question id, the
+# question's possible response numeric value, and the corresponding text,
+# in the order of the file. A row with no question id belongs to the
+# question above it, and rows without a value or a text are left out. The
+# table can still have duplicated (question, value) pairs, which are
+# reported by the validation of SurveyPivoter.
+def read_value_domain(filename):
+    range_df = read_input_file(filename)
+
+    # rename the columns in the filename for easy use
+    range_df.rename(columns=dict(zip(range_df.columns, ["Question", "Value", "Label"])), inplace=True)
+
+    # clean data frame for \t, \r and \n symbols
+    clean_dataframe(range_df)
+
+    # fill in the question id of the rows that belong to the question
+    # above them, then drop the incomplete rows
+    range_df["Question"] = range_df["Question"].ffill().fillna("")
+    range_df = range_df.dropna(subset=["Value", "Label"])
+    range_df["Value"] = range_df["Value"].astype(int)
+
+    return range_df.reset_index(drop=True)
+
+# build a domain table, as read by read_value_domain, from a map of maps
+# with the key being the question ID, and the inner map mapping the
+# question's possible response values to their text
+def get_domain_table_from_map(domain_map):
+    return pd.DataFrame([(question, value, label) for question, domain in domain_map.items()
+        for value, label in domain.items()], columns=["Question", "Value", "Label"])
+
+# build the map of maps form of a domain table
+def get_domain_map_from_table(table):
+    domain_map = {}
+    for question, value, label in zip(table["Question"], table["Value"], table["Label"]):
+        if question not in domain_map:
+            domain_map[question] = {}
+        domain_map[question][int(value)] = label
+    return domain_map
+
+# the parsed mapping files of the current process, most recently used last,
+# keyed by the reading function and the path, size and modification time of
+# the file
+mapping_files = OrderedDict()
+
+# read a mapping file with the function read (read_variable_labels or
+# read_value_domain), keeping the MAPPING_CACHE_SIZE most recently used
+# parsed files in memory, so that the surveys pivoted by a long-running 
+# process (see PIVOT SERVER) that share mapping files only parse them once.
+# A file is parsed again as soon as it changes. The parsed mappings are
+# shared, and should not be modified.
+def read_mapping_file(read, filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return read(filename)
+
+    key = (read.__name__, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key in mapping_files:
+        mapping_files.move_to_end(key)
+        return mapping_files[key]
+
+    mapping = read(filename)
+    mapping_files[key] = mapping
+    while len(mapping_files) > MAPPING_CACHE_SIZE:
+        mapping_files.popitem(last=False)
+    return mapping
+
+# build the value data frame of a survey from the values file value_df: its
+# columns varnames, converted one at a time to categoricals (see 
+# get_value_column), cleaned but for the first one, as clean_dataframe does.
+# Each column keeps its own values, so e.g. the integers of a column of 
+# integers are written as such, whatever the dtype of the other columns.
+def get_value_frame(value_df, varnames):
+    return pd.DataFrame(OrderedDict((v, get_value_column(value_df[v], clean=(i > 0)))
+        for i, v in enumerate(varnames)), index=value_df.index)
+
+# =============================================
+# PREPROCESSING FILE
+# =============================================
+
+# pivot the survey described by config_file, with the options of the command
+# line (args), and write the output file(s). The settings can also be given
+# directly as a dict (cfg), in which case config_file only names the survey
+# in messages. Returns the final product (the long table), or None in 
+# chunked and validation modes, where it is never held in memory.
+def pivot_survey(config_file, args, cfg=None):
+    profile = create_profile(vars(args)) if args.profile else None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # parse the yaml file and store information into the appropriate
+    # variables
+    if cfg is None:
+        cfg = read_config(config_file)
+    try:
+        year = cfg['year']
+        survey_name = cfg['survey_name']
+        weight_col = cfg['weight_col']
+        input_filename_v = cfg['input_filename_with_values']
+        input_filename_questions_to_text = cfg['input_filename_questions_to_text']
+        input_filename_values_to_labels = cfg['input_filename_values_to_labels']
+        columns_to_ignore = cfg['columns_to_ignore']
+        exclude_from_domain_analysis = cfg['exclude_from_domain_analysis']
+        common_string_threshold = cfg['common_string_threshold']
+    except KeyError as e:
+        raise KeyError("Expected variable {} in config file {} but it wasn't found".format(e, config_file))
+
+    # optional settings for the input cache. The cache is disabled if no
+    # cache_dir is specified
+    cache_dir = cfg.get('cache_dir') if not args.no_cache else None
+    cache_max_size_mb = cfg.get('cache_max_size_mb', 1024)
+
+    # optional output format, the command line argument takes precedence
+    # over the config file
+    output_format = args.output_format or cfg.get('output_format', 'xlsx')
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output_format {} in config file {}, expected one of {}".format(
+            output_format, config_file, ", ".join(OUTPUT_FORMATS)))
+
+    # optional maximum number of rows of an xlsx output file, bigger outputs
+    # are split between several files
+    xlsx_max_rows = min(cfg.get('xlsx_max_rows', EXCEL_MAX_ROWS), EXCEL_MAX_ROWS)
+
+    # optional star schema output
+    star_schema = args.star_schema or cfg.get('star_schema', False)
+
+    # optional response cube output, crossed with the attribute columns of
+    # response_cube_attributes (as named in the input file)
+    response_cube = args.response_cube or cfg.get('response_cube', False)
+    response_cube_attributes = cfg.get('response_cube_attributes', [])
+
+    # optional state directory of the incremental mode. The mode is disabled
+    # if no incremental_dir is specified
+    incremental_dir = cfg.get('incremental_dir')
+
+    # chunked mode. The validation mode writes no output, so the output
+    # options don't matter there
+    chunk_size = args.chunk_size
+    if chunk_size and not args.validate:
+        if output_format not in ["csv", "parquet"]:
+            raise ValueError("The chunked mode requires the csv or parquet output format, not {}".format(
+                output_format))
+        if star_schema:
+            raise ValueError("The chunked mode can't write a star schema output")
+        if incremental_dir:
+            raise ValueError("The chunked mode can't be used with incremental_dir in config file {}".format(
+                config_file))
+
+    output_file = '{}_{}_pivoted.{}'.format(year, survey_name.lower().replace(' ', '_'), output_format)
+    response_cube_file = '{}_cube.{}'.format(os.path.splitext(output_file)[0], output_format)
+
+    # print the warnings collected so far
+    def flush_warnings():
+        for warning in pivoter.warning_messages:
+            print(warning)
+        pivoter.warning_messages[:] = []
+
+    # =============================================
+    # MAIN PROCESS
+    # =============================================
+
+    # the ignored columns, as a set for constant time lookups on wide files
+    ignored_columns = set(columns_to_ignore)
+
+    # look up the parsed inputs in the cache. The values entry depends on
+    # the values file, the question to text file and the ignored columns, and
+    # the domain entry only depends on the value to label file.
+    values_cache = domain_cache = None
+    if cache_dir:
+        values_key = get_cache_key("values", [hash_file(input_filename_v),
+            hash_file(input_filename_questions_to_text)], {'columns_to_ignore': columns_to_ignore})
+        domain_key = get_cache_key("domain", [hash_file(input_filename_values_to_labels)], {})
+        values_cache = read_cache(cache_dir, values_key)
+        domain_cache = read_cache(cache_dir, domain_key)
+        profile_stage(profile, "read_cache")
+
+    if chunk_size:
+        # only read the first chunk of respondents here, the others are read
+        # while pivoting
+        value_chunks = read_excel_chunks(input_filename_v, chunk_size)
+        value_df = next(value_chunks)
+        profile_stage(profile, "read_values", value_df)
+
+        # obtain all the variable names of the columns
+        varnames = [x for x in value_df.columns if x not in ignored_columns]
+
+        # obtain all the labels of the columns
+        varmap = read_mapping_file(read_variable_labels, input_filename_questions_to_text)
+        profile_stage(profile, "read_labels")
+
+    elif values_cache:
+        df = values_cache[0]['values']
+        varnames = values_cache[1]['varnames']
+        varmap = dict(zip(values_cache[1]['label_names'], values_cache[1]['label_texts']))
+
+    else:
+        value_df = read_input_file(input_filename_v)
+        profile_stage(profile, "read_values", value_df)
+
+        # obtain all the variable names of the columns
+        varnames = [x for x in value_df.columns if x not in ignored_columns]
+
+        # obtain all the labels of the columns
+        varmap = read_mapping_file(read_variable_labels, input_filename_questions_to_text)
+        profile_stage(profile, "read_labels")
+
+        df = get_value_frame(value_df, varnames)
+        profile_stage(profile, "clean_dataframe", df)
+
+        # only the labels of the value columns are cached
+        if cache_dir:
+            label_names = [name for name in varnames if name in varmap and not pd.isnull(varmap[name])]
+            write_cache(cache_dir, values_key, {'values': df}, {'varnames': varnames,
+                'label_names': label_names, 'label_texts': [varmap[name] for name in label_names]},
+                cache_max_size_mb)
+            profile_stage(profile, "write_cache")
+
+    # obtain the domain table of all questions, if applicable
+    if domain_cache:
+        domain_frame = domain_cache[0]['domain']
+    else:
+        domain_frame = read_mapping_file(read_value_domain, input_filename_values_to_labels)
+
+        if cache_dir:
+            write_cache(cache_dir, domain_key, {'domain': domain_frame}, {}, cache_max_size_mb)
+
+    profile_stage(profile, "read_domain")
+
+    # compile the domains into a lookup table of response texts, once
+    pivoter = SurveyPivoter(cfg, varmap, domain_frame)
+    profile_stage(profile, "compile_domain_table")
+
+    # find the attributes, and the columns to pivot, and rename the columns
+    # that are used as attributes
+    plan = pivoter.get_column_plan(varnames)
+    attribute_col = plan['attribute_col']
+    pivot_cols = plan['pivot_cols']
+
+    # the attribute columns of the response cube, as named in the final product
+    cube_cols = []
+    for name in response_cube_attributes if response_cube else []:
+        if plan['attributes_rename'].get(name) not in attribute_col:
+            raise ValueError("Unknown attribute {} in response_cube_attributes of config file {}".format(
+                name, config_file))
+        cube_cols.append("Attribute - {}".format(plan['attributes_rename'][name]))
+
+    # prepare a chunk of respondents of the values file, as read in chunked
+    # mode, the same as the whole data frame
+    def prepare_chunk(value_df):
+        return pivoter.prepare_values(get_value_frame(value_df, varnames), plan)
+
+    # in chunked mode, the first chunk stands for the data frame until the
+    # pivoting, as all chunks share the same columns
+    if chunk_size:
+        df = prepare_chunk(value_df)
+    else:
+        pivoter.prepare_values(df, plan)
+
+    # flush warning messages
+    flush_warnings()
+    profile_stage(profile, "rename_columns", df)
+
+    # validate all the responses and domains up front, before any pivot work,
+    # and report every problem at once. In chunked mode, only the first chunk
+    # is validated (the other ones are still checked while pivoting), unless
+    # in validation mode, where every chunk is.
+    missing_counts = pivoter.count_missing_labels(df, plan)
+    if args.validate and chunk_size:
+        for value_df in progress(value_chunks, desc="Validating chunks"):
+            missing_counts = missing_counts.add(pivoter.count_missing_labels(prepare_chunk(value_df), plan),
+                fill_value=0)
+        missing_counts = missing_counts.astype(int)
+
+    validation_report = pivoter.get_validation_report(plan, missing_counts)
+    validation_errors = validation_report[validation_report['Severity'] == 'error']
+    validation_warnings = validation_report[validation_report['Check'] == 'domain']
+    profile_stage(profile, "validate", validation_report)
+
+    if args.validate or len(validation_errors):
+        report_file = '{}_validation.csv'.format(os.path.splitext(output_file)[0])
+        validation_report.to_csv(report_file, index=False)
+
+        for message in validation_errors['Message']:
+            print(ERROR_TAG + message)
+
+    if args.validate:
+        for message in validation_warnings['Message']:
+            print(WARNING_TAG + message)
+        print('------------------------------------------------------------------')
+        print('Validation report ({} error(s), {} warning(s)) was written to {}'.format(len(validation_errors),
+            len(validation_report) - len(validation_errors), report_file))
+        return None
+
+    if len(validation_errors):
+        raise SurveyValidationError("{} error(s) in the input files, see the validation report {}. Exiting."
+            .format(len(validation_errors), report_file), validation_report)
+
+    pivoter.warning_messages.extend(WARNING_TAG + message for message in validation_warnings['Message'])
+
+    # resolve the metadata of every question once. The group texts depend on
+    # the order of the questions, so this is done serially, before pivoting.
+    question_dimension = pivoter.get_question_dimension(plan)
+    profile_stage(profile, "question_dimension", question_dimension)
+
+    # in incremental mode, only pivot the questions whose fingerprint changed
+    # since the last run, or all of them if the settings changed
+    changed_cols = pivot_cols
+    if incremental_dir:
+        manifest = {
+            'settings': hash_data([survey_name, year, weight_col, attribute_col, common_string_threshold,
+                exclude_from_domain_analysis, hash_frame(df[attribute_col + [weight_col]])]),
+            'questions': {v: hash_data([hash_frame(df[v]), plan['varmap'].get(v),
+                question_dimension.loc[v].tolist()]) for v in pivot_cols}
+        }
+
+        incremental_state = read_incremental_state(incremental_dir, output_file) if not args.full else None
+        if incremental_state and incremental_state[0]['settings'] == manifest['settings']:
+            previous_questions = incremental_state[0]['questions']
+            changed_cols = [v for v in pivot_cols if previous_questions.get(v) != manifest['questions'][v]]
+            print("Incremental mode: pivoting {} of {} question(s)".format(len(changed_cols), len(pivot_cols)))
+        else:
+            incremental_state = None
+        profile_stage(profile, "fingerprints")
+
+    # the questions are pivoted in the order of the output, sorted by question
+    # id (the survey name and year are the same for all questions), so that
+    # the final product doesn't have to be sorted
+    pivot_order = sorted(changed_cols)
+
+    # in chunked mode, the chunks are pivoted while writing the output
+    engine = "melt" if chunk_size else args.engine
+    dataframes = []
+    if not chunk_size:
+        dataframes = pivoter.pivot_questions(df, plan, pivot_order, engine, args.workers, profile,
+            show_progress=True)
+
+    profile_stage(profile, "pivot", dataframes)
 
     # flush out warning messages
-    for warning in warning_messages:
-        print(warning)
-    warning_messages[:] = []
+    flush_warnings()
+
+    # report every response that doesn't have a mapping in its question's
+    # domain at once, instead of stopping at the first one
+    def report_missing_labels():
+        for column_name, item in pivoter.missing_labels:
+            print((ERROR_TAG + "Do not find a mapping for the current value {} of column {}. "
+                + "Please recheck your mapping file").format(item, column_name))
+        raise SurveyPivoterError("{} response value(s) without a mapping. Exiting.".format(
+            len(pivoter.missing_labels)))
+
+    if pivoter.missing_labels:
+        report_missing_labels()
 
     # =============================================
     # FINAL PRODUCT
-    # ============================================= 
+    # =============================================
 
-    # print(list(map(lambda x: "Attribute - {}".format(x), attribute_col)))
+    # the final product of all questions. In incremental mode, the rows of
+    # the questions that didn't change are taken from the previous final
+    # product, and the new state is stored for the next run.
+    def get_incremental_final_product(dataframes):
+        if not incremental_dir:
+            return pivoter.get_final_product(dataframes, plan)
+
+        new_product = pivoter.get_final_product(dataframes, plan) if dataframes else None
+        previous_product = incremental_state[1] if incremental_state else None
+        changed = set(changed_cols)
+
+        # the questions are sorted in both the new and the previous final
+        # products, so the rows of every question are sliced out of the one
+        # it comes from, in the order of a full run
+        question_ids = {}
+        for frame in (new_product, previous_product):
+            if frame is not None:
+                question_ids[id(frame)] = frame['Question - ID'].to_numpy(dtype=object)
+
+        final_products = []
+        for v in sorted(pivot_cols):
+            frame = new_product if v in changed else previous_product
+            ids = question_ids[id(frame)]
+            final_products.append(frame.iloc[np.searchsorted(ids, v, 'left'):np.searchsorted(ids, v, 'right')])
+
+        final_product = pd.concat(final_products)
+        write_incremental_state(incremental_dir, output_file, final_product, manifest)
+        return final_product
+
+    # pivot the chunks of respondents one at a time, starting with the first
+    # one that was already read. Stops at the first chunk with a response
+    # that doesn't have a mapping. The partial sums of the response cube are
+    # aggregated from every chunk, if needed.
+    cube_sums = []
+    def pivot_chunks():
+        chunk_df = df
+        while True:
+            chunk_product = pivoter.get_final_product([pivoter.melt_pivot(chunk_df, pivot_order, plan)], plan)
+            if response_cube:
+                cube_sums.append(aggregate_responses(chunk_product, cube_cols, pivoter.get_property_tables(plan)))
+            yield chunk_product
+
+            value_df = next(value_chunks, None)
+            if value_df is None or pivoter.missing_labels:
+                return
 
-    final_product = pd.concat(dataframes)
-    final_product.rename(index=str, \
-        columns=dict(zip(attribute_col, list(map(lambda x: "Attribute - {}".format(x), attribute_col)))),
-        inplace=True)
-    final_product = final_product[final_product['Response - Text'].notnull()]
-    final_product = final_product[final_product['Response - Value'].str.strip() != '']
-    final_product = final_product.replace("#NULL!", "No response")
-    final_product = final_product.sort_values(['Year', 'Survey Name', 'Question - ID'])
+            chunk_df = prepare_chunk(value_df)
 
-    # save as excel (smaller file size, longer write time)
-    writer = pd.ExcelWriter(output_file, engine='xlsxwriter')
-    pd.formats.format.header_style = None
-    final_product.to_excel(writer, startcol=0, startrow=0, index=False, sheet_name="Sheet1")
-    writer.save()
+    if chunk_size:
+        # the output is written in order of chunks, so the rows are sorted by
+        # question within each chunk of respondents
+        final_product = None
+        schema = None
+        if output_format == "parquet":
+            schema = get_output_schema(['Survey Name', 'Year'] +
+                ['Attribute - {}'.format(v) for v in plan['attribute_col']] + PIVOTED_COLUMNS, year)
+        output_files = write_output_chunks(progress(pivot_chunks(), desc="Pivoting chunks"), output_file,
+            output_format, schema)
+        profile_stage(profile, "pivot_and_write_chunks")
 
-    # save as csv (larger file size, faster write time)
-    # final_product.to_csv(output_file, index=False)
+        if pivoter.missing_labels:
+            for output_file in output_files:
+                os.remove(output_file)
+            report_missing_labels()
+    elif star_schema:
+        respondent_dimension = pivoter.get_respondent_dimension(df, plan)
+
+        final_product = get_incremental_final_product(dataframes)
+        profile_stage(profile, "final_product", final_product)
+
+        output_files = write_star_schema(final_product, question_dimension, respondent_dimension,
+            output_file, output_format, xlsx_max_rows)
+
+    else:
+        final_product = get_incremental_final_product(dataframes)
+        profile_stage(profile, "final_product", final_product)
+
+        output_files = write_output(final_product, output_file, output_format, xlsx_max_rows)
+
+    profile_stage(profile, "write_output")
+
+    if response_cube:
+        if not chunk_size:
+            cube_sums.append(aggregate_responses(final_product, cube_cols, pivoter.get_property_tables(plan)))
+        output_files += write_output(get_response_cube(cube_sums, cube_cols), response_cube_file, output_format,
+            xlsx_max_rows)
+        profile_stage(profile, "response_cube")
 
     print('------------------------------------------------------------------')
-    print('Reshaped output file was successfully written to {}'.format(output_file))
+    for output_file in output_files:
+        print('Reshaped output file was successfully written to {}'.format(output_file))
+
+    if args.profile:
+        write_profile(profile, args.profile)
+        print('Profile report was written to {}'.format(args.profile))
+
+    if args.cprofile:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print('cProfile statistics were written to {}'.format(args.cprofile))
+
+    return final_product
+
+# =============================================
+# BATCH PROCESSING
+# =============================================
+
+# expand the config files given on the command line: a directory stands for
+# all the yaml files it contains, in alphabetical order
+def get_config_files(paths):
+    config_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            config_files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) 
+                if f.endswith('.yml') or f.endswith('.yaml')))
+        else:
+            config_files.append(path)
+    return config_files
+
+# combine the final products of several surveys (e.g. of different years) 
+# into a single longitudinal table. The attribute columns of the surveys are
+# unioned, in order of first appearance, and are empty for the surveys that
+# don't have them.
+def combine_final_products(final_products):
+    attribute_cols = []
+    for final_product in final_products:
+        for v in final_product.columns:
+            if v.startswith("Attribute - ") and v not in attribute_cols:
+                attribute_cols.append(v)
+
+    combined = pd.concat(final_products)
+    other_cols = [v for v in combined.columns if v not in attribute_cols and v not in ['Survey Name', 'Year']]
+    combined = combined[['Survey Name', 'Year'] + attribute_cols + other_cols]
+
+    return combined.sort_values(['Year', 'Survey Name', 'Question - ID'], kind='mergesort')
+
+# pivot a survey of a batch, in a worker process of pivot_batch. The final
+# product is only sent back to pivot_batch if it writes a combined output,
+# so that the outputs of the surveys are not all held in its memory 
+# otherwise.
+def pivot_batch_survey(config_file, args):
+    final_product = pivot_survey(config_file, args)
+    return final_product if args.combined_output else None
+
+# pivot several surveys in parallel, with a pool of args.jobs processes. A 
+# failing survey is reported, and doesn't stop the others. If requested, the
+# outputs of all the surveys are also written as a single longitudinal table.
+# Returns the list of the config files of the failed surveys.
+def pivot_batch(config_files, args):
+    # every survey gets its own profile reports, named after its config file
+    def get_profile_file(profile_file, config_file):
+        if not profile_file:
+            return profile_file
+        base, ext = os.path.splitext(profile_file)
+        return "{}_{}{}".format(base, os.path.splitext(os.path.basename(config_file))[0], ext)
+
+    futures = []
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(config_files))) as executor:
+        for config_file in config_files:
+            survey_args = copy.copy(args)
+            survey_args.profile = get_profile_file(args.profile, config_file)
+            survey_args.cprofile = get_profile_file(args.cprofile, config_file)
+            futures.append(executor.submit(pivot_batch_survey, config_file, survey_args))
+
+        final_products = []
+        failed = []
+        for config_file, future in zip(config_files, futures):
+            try:
+                final_product = future.result()
+            except BaseException as e:
+                print((ERROR_TAG + "Pivoting {} failed. Error log: {!r}").format(config_file, e))
+                failed.append(config_file)
+                continue
+            if final_product is not None:
+                final_products.append(final_product)
+
+    if args.combined_output and final_products:
+        output_format = os.path.splitext(args.combined_output)[1][1:]
+        output_files = write_output(combine_final_products(final_products), args.combined_output, output_format)
+
+        print('------------------------------------------------------------------')
+        for output_file in output_files:
+            print('Combined output file was successfully written to {}'.format(output_file))
+
+    if failed:
+        print((ERROR_TAG + "{} of {} survey(s) failed: {}").format(len(failed), len(config_files), 
+            ", ".join(failed)))
+
+    return failed
+
+# =============================================
+# PIVOT SERVER
+# =============================================
+# In server mode (--serve PORT), the script keeps running and accepts pivot 
+# jobs over http on localhost, so that many surveys can be pivoted without 
+# paying for the start of python, the imports and the parsing of the shared
+# mapping files for every one of them. The jobs are queued, and run by a 
+# pool of worker processes that are started and warmed up with the server,
+# and keep the recently used mapping files parsed (see read_mapping_file).
+#
+#   POST /jobs       submit a job, with either "config_file" (the path of a
+#                    config file) or "config" (the settings of a config 
+#                    file), and optionally "args" (command line options, e.g.
+#                    ["--engine", "melt"]) and "cwd" (the directory the paths
+#                    of the config are relative to, default: the server's)
+#   GET /jobs        the status and timings of all the jobs
+#   GET /jobs/<id>   the status, timings and output of a job
+
+# import the optional modules used while pivoting up front, so that the 
+# first job of a worker process doesn't pay for it
+def warm_worker():
+    for module in ['yaml', 'tqdm', 'xlsxwriter', 'openpyxl', 'pyarrow']:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+# initialize a worker process of the pivot server. Interruptions are handled
+# by the server, which shuts its workers down.
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_worker()
+
+# run a job in a worker process: pivot the survey of config_file (or of the
+# settings cfg) with the options args, from the directory cwd. Returns what 
+# the pivot printed, its error if it failed, the number of rows of the final
+# product, and the wall time and pid of the worker.
+def run_pivot_job(config_file, cfg, args, cwd):
+    start_time = time.time()
+    log = io.StringIO()
+    result = {'worker': os.getpid(), 'rows': None, 'error': None}
+
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(log):
+            final_product = pivot_survey(config_file, args, cfg)
+        if final_product is not None:
+            result['rows'] = len(final_product)
+    except (Exception, SystemExit) as e:
+        result['error'] = repr(e)
+
+    result['log'] = log.getvalue()
+    result['wall_time'] = time.time() - start_time
+    return result
+
+# run the pivot server on localhost:port, with a pool of args.jobs worker 
+# processes, until it is interrupted
+def serve(port, args):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from concurrent.futures.process import BrokenProcessPool
+
+    parser = get_argument_parser()
+
+    # the status of the jobs by id, in order of submission, and the queue of
+    # the jobs waiting for a worker
+    jobs = OrderedDict()
+    jobs_lock = threading.Lock()
+    job_queue = queue.Queue()
+    next_job_id = [1]
+
+    # start every worker process before accepting jobs. The imports of the 
+    # server are inherited by forked workers.
+    warm_worker()
+    pool = [ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker)]
+    for future in [pool[0].submit(time.sleep, 0.1) for i in range(args.jobs)]:
+        future.result()
+
+    # parse a submitted job into the arguments of run_pivot_job, raising a
+    # ValueError if it isn't valid
+    def parse_job(request):
+        if not isinstance(request, dict) or ('config_file' in request) == ('config' in request):
+            raise ValueError("A job needs either a \"config_file\" or a \"config\"")
+
+        job_args = request.get('args', [])
+        try:
+            job_args = parser.parse_args([str(arg) for arg in job_args])
+        except SystemExit:
+            raise ValueError("Invalid args {}".format(job_args))
+        if job_args.config_files or job_args.combined_output or job_args.serve:
+            raise ValueError("The args of a job can't have config files, --combined-output or --serve")
+
+        cwd = os.path.abspath(request.get('cwd', os.getcwd()))
+        return request.get('config_file', '<inline config>'), request.get('config'), job_args, cwd
+
+    # run the queued jobs, one at a time per worker process. A pool broken by
+    # a worker that died is replaced, and its job fails.
+    def dispatch():
+        while True:
+            job_id, job_settings = job_queue.get()
+            with jobs_lock:
+                job = jobs[job_id]
+                job['status'] = 'running'
+                job['queue_time'] = time.time() - job['submit_time']
+                executor = pool[0]
+
+            try:
+                result = executor.submit(run_pivot_job, *job_settings).result()
+            except BrokenProcessPool as e:
+                result = {'error': repr(e)}
+                with jobs_lock:
+                    if pool[0] is executor:
+                        pool[0] = ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker)
+
+            with jobs_lock:
+                job.update(result)
+                job['status'] = 'failed' if job['error'] else 'done'
+                job['run_time'] = time.time() - job['submit_time'] - job['queue_time']
+
+                # forget the oldest finished jobs
+                finished = [other for other in jobs if jobs[other]['status'] in ['done', 'failed']]
+                for other in finished[:max(len(jobs) - SERVER_MAX_JOBS, 0)]:
+                    del jobs[other]
+
+    for i in range(args.jobs):
+        threading.Thread(target=dispatch, daemon=True).start()
+
+    class JobHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, data):
+            body = json.dumps(data, default=str).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            with jobs_lock:
+                if parts == ['jobs']:
+                    data = [{k: v for k, v in job.items() if k != 'log'} for job in jobs.values()]
+                elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit() and int(parts[1]) in jobs:
+                    data = dict(jobs[int(parts[1])])
+                else:
+                    data = None
+
+            if data is None:
+                self.send_json(404, {'error': "Unknown path {}".format(self.path)})
+            else:
+                self.send_json(200, data)
+
+        def do_POST(self):
+            if self.path.strip('/') != 'jobs':
+                self.send_json(404, {'error': "Unknown path {}".format(self.path)})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                job_settings = parse_job(request)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            with jobs_lock:
+                job_id = next_job_id[0]
+                next_job_id[0] += 1
+                jobs[job_id] = {
+                    'id': job_id,
+                    'status': 'queued',
+                    'config_file': job_settings[0],
+                    'args': request.get('args', []),
+                    'cwd': job_settings[3],
+                    'submitted': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'submit_time': time.time(),
+                    'queue_time': None,
+                    'run_time': None,
+                    'error': None
+                }
+                job_queue.put((job_id, job_settings))
+                data = dict(jobs[job_id])
+
+            self.send_json(202, data)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), JobHandler)
+    print('Pivot server listening on http://127.0.0.1:{} with {} worker(s)'.format(port, args.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool[0].shutdown(wait=False, cancel_futures=True)
+
+# the parser of the command line options, also used for the options of the
+# jobs of the pivot server
+def get_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_files", nargs='*', help="Path to config yaml file with survey-specific " + 
+        "settings (e.g. config.yml). Several config files, or directories of config files, can be given to " +
+        "pivot several surveys in parallel")
+    parser.add_argument("--engine", choices=["loop", "melt"], default="loop",
+        help="Pivot engine to use: 'loop' builds one data frame per question, 'melt' reshapes " +
+        "all questions at once (default: loop)")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS,
+        help="Format of the output file, overrides output_format in the config file (default: xlsx)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes resolving the responses of the questions in parallel with the loop engine " +
+        "(default: 1). The output is the same as with a single worker")
+    parser.add_argument("--chunk-size", type=int, default=0,
+        help="Read and pivot the values file in chunks of this many respondents, writing the output " +
+        "incrementally, to bound memory usage on very large files. Uses the melt engine, and requires " +
+        "the csv or parquet output format")
+    parser.add_argument("--star-schema", action="store_true",
+        help="Write the output as a star schema (a fact table with a question and a respondent dimension " +
+        "table) instead of a single long table, overrides star_schema in the config file")
+    parser.add_argument("--response-cube", action="store_true",
+        help="Also write the weighted counts and property means of every question and response, " +
+        "overrides response_cube in the config file")
+    parser.add_argument("--profile", metavar="REPORT_FILE",
+        help="Record the wall time, peak memory and data size of every stage, and the slowest questions, " +
+        "in a json report")
+    parser.add_argument("--cprofile", metavar="STATS_FILE",
+        help="Run under cProfile, and dump the statistics to this file (readable with pstats)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+        help="Number of processes pivoting surveys in parallel when several config files are given " +
+        "(default: number of CPUs)")
+    parser.add_argument("--combined-output", metavar="OUTPUT_FILE",
+        help="Also write the output of all the surveys to this file, as a single longitudinal table. " +
+        "The format is given by the extension of the file (xlsx, parquet, feather or csv)")
+    parser.add_argument("--validate", action="store_true",
+        help="Only check the input files, and write every problem found to a validation report")
+    parser.add_argument("--full", action="store_true",
+        help="Pivot all questions, ignoring the state of the previous run in incremental mode")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Read the input files directly, without using or updating the input cache")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+        help="Run as a server accepting pivot jobs over http on localhost:PORT, run by --jobs worker processes")
+    return parser
+
+def main():
+    parser = get_argument_parser()
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args)
+        return
+    if not args.config_files:
+        parser.error("the following arguments are required: config_files")
+
+    config_files = get_config_files(args.config_files)
+    if not config_files:
+        parser.error("No config file (.yml or .yaml) was found in {}".format(", ".join(args.config_files)))
+
+    if args.combined_output:
+        output_format = os.path.splitext(args.combined_output)[1][1:]
+        if output_format not in OUTPUT_FORMATS:
+            parser.error("The extension of --combined-output should be one of {}".format(", ".join(OUTPUT_FORMATS)))
+        if args.chunk_size:
+            parser.error("--combined-output can't be used in chunked mode")
+
+    if len(config_files) == 1 and not args.combined_output:
+        try:
+            pivot_survey(config_files[0], args)
+        except SurveyPivoterError as e:
+            print(ERROR_TAG + str(e))
+            sys.exit(1)
+    elif pivot_batch(config_files, args):
+        sys.exit(1)
 
 if __name__ == "__main__":
     start_time = time.time()